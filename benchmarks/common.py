@@ -0,0 +1,29 @@
+"""
+Helpers, shared by benchmarks
+"""
+
+import sys
+
+from pathlib import Path
+
+sys.path.insert(0, Path(__file__).absolute().parent.parent.as_posix())
+import smartobject
+
+
+def make_class(property_map):
+    """
+    Create Smart Object class with the static property map
+
+    The map is static and valid, so per-object schema validation is skipped
+    """
+
+    class Item(smartobject.SmartObject):
+
+        def __init__(self, id=None):
+            self.id = id
+            self._property_map = {
+                k: v.copy() for k, v in property_map.items()
+            }
+            self.apply_property_map()
+
+    return Item
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+SmartObjectFactory multi-threaded contention benchmark
+
+Threads auto-load objects from a storage with a simulated I/O latency, then
+read already loaded objects
+"""
+
+import time
+import argparse
+import threading
+
+from common import make_class, smartobject
+
+PROPERTY_MAP = {
+    'id': {
+        'pk': True,
+        'type': int
+    },
+    'value': {
+        'type': int,
+        'default': 0,
+        'store': True
+    }
+}
+
+
+Item = make_class(PROPERTY_MAP)
+
+
+class SlowStorage(smartobject.AbstractStorage):
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def load(self, pk, **kwargs):
+        time.sleep(self.latency)
+        return {'value': pk}
+
+
+def run(factory, threads, keys):
+
+    def worker(keys):
+        for k in keys:
+            factory.get(k)
+
+    workers = [
+        threading.Thread(target=worker, args=(keys[i::threads],))
+        for i in range(threads)
+    ]
+    t_start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return len(keys) / (time.perf_counter() - t_start)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    ap.add_argument('-n',
+                    '--objects',
+                    type=int,
+                    default=2000,
+                    help='number of objects (default: 2000)')
+    ap.add_argument('-l',
+                    '--latency',
+                    type=float,
+                    default=0.001,
+                    help='storage load latency, seconds (default: 0.001)')
+    ap.add_argument('-t',
+                    '--threads',
+                    default='1,2,4,8,16,32',
+                    help='thread counts to test (default: 1,2,4,8,16,32)')
+    a = ap.parse_args()
+    smartobject.define_storage(SlowStorage(a.latency))
+    print(f'objects: {a.objects}, storage latency: {a.latency} sec')
+    print(f'{"threads":>8} {"loads/sec":>12} {"gets/sec":>12}')
+    for threads in [int(t) for t in a.threads.split(',')]:
+        factory = smartobject.SmartObjectFactory(Item, autoload=True)
+        keys = list(range(a.objects))
+        loads = run(factory, threads, keys)
+        gets = run(factory, threads, keys * 10)
+        print(f'{threads:>8} {round(loads):>12} {round(gets):>12}')
+
+
+if __name__ == '__main__':
+    main()
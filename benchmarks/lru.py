@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+SmartObjectFactory LRU benchmark
+
+Fills the factory cache (default: 100k entries) with 1M inserts and measures
+insert and lookup rates
+"""
+
+import time
+import argparse
+
+from common import make_class, smartobject
+
+PROPERTY_MAP = {
+    'id': {
+        'pk': True,
+        'type': int
+    },
+    'value': {
+        'type': int,
+        'default': 0
+    }
+}
+
+
+Item = make_class(PROPERTY_MAP)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    ap.add_argument('-s',
+                    '--maxsize',
+                    type=int,
+                    default=100000,
+                    help='factory max size (default: 100000)')
+    ap.add_argument('-n',
+                    '--inserts',
+                    type=int,
+                    default=1000000,
+                    help='number of inserts (default: 1000000)')
+    a = ap.parse_args()
+    factory = smartobject.SmartObjectFactory(Item, maxsize=a.maxsize)
+    t_insert = 0
+    for i in range(a.inserts):
+        o = Item(i)
+        t_start = time.perf_counter()
+        factory.append(o)
+        t_insert += time.perf_counter() - t_start
+    assert len(factory._objects) == min(a.maxsize, a.inserts)
+    keys = list(factory._objects)
+    t_start = time.perf_counter()
+    for k in keys:
+        factory.get(k)
+    t_get = time.perf_counter() - t_start
+    print(f'maxsize: {a.maxsize}, inserts: {a.inserts}')
+    print(f'insert: {t_insert:.3f} sec, '
+          f'{round(a.inserts / t_insert)} inserts/sec')
+    print(f'get: {t_get:.3f} sec, {round(len(keys) / t_get)} gets/sec')
+
+
+if __name__ == '__main__':
+    main()
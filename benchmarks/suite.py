@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+SmartObject benchmark suite
+
+Measures set_prop, serialize, save, load and factory append / get rates for
+different object widths (number of props), object counts and storages. Results
+(operations per second) are written as JSON and can be compared with a stored
+baseline
+"""
+
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import importlib
+
+import common
+
+from common import smartobject
+
+STORAGES = ('JSONStorage', 'YAMLStorage', 'PickleStorage',
+            'MessagePackStorage', 'CBORStorage', 'SQLAStorage')
+
+
+def make_class(width):
+    property_map = {'id': {'pk': True, 'type': str}}
+    for i in range(width):
+        property_map[f'p{i}'] = {'type': str, 'default': '', 'store': True}
+    return common.make_class(property_map)
+
+
+def make_storage(name, width, dir):
+    if name == 'SQLAStorage':
+        sa = importlib.import_module('sqlalchemy')
+        db = sa.create_engine(f'sqlite:///{dir}/bench.db')
+        fields = ''.join(f', p{i} varchar(64)' for i in range(width))
+        db.execute(f'create table items (id varchar(64) primary key{fields})')
+        return smartobject.SQLAStorage(db, 'items')
+    else:
+        storage = getattr(smartobject, name)()
+        storage.dir = dir
+        return storage
+
+
+def measure(fn, items, repeat):
+    # returns the best rate of all runs, operations per second. if items is a
+    # function, it is called before each run to get fresh items
+    best = None
+    for _ in range(repeat):
+        run_items = items() if callable(items) else items
+        t_start = time.perf_counter()
+        for i in run_items:
+            fn(i)
+        t = time.perf_counter() - t_start
+        best = t if best is None else min(best, t)
+    return len(run_items) / best if best else 0
+
+
+def run(widths, counts, storages, repeat):
+    results = {}
+    for width in widths:
+        Item = make_class(width)
+        values = {f'p{i}': f'value{i}' for i in range(width)}
+        for count in counts:
+            case = f'w{width}/n{count}'
+            objects = [Item(f'item{i}') for i in range(count)]
+            # values are set to fresh objects in each run, otherwise runs
+            # after the first one measure unchanged values only
+            results[f'set_prop/{case}'] = measure(
+                lambda o: o.set_prop(values),
+                lambda: [Item(f'item{i}') for i in range(count)], repeat)
+            results[f'serialize/{case}'] = measure(lambda o: o.serialize(),
+                                                   objects, repeat)
+            factory = smartobject.SmartObjectFactory(Item)
+            results[f'factory.append/{case}'] = measure(
+                lambda o: factory.append(o, override=True), objects, repeat)
+            pks = [o.id for o in objects]
+            results[f'factory.get/{case}'] = measure(factory.get, pks, repeat)
+            for name in storages:
+                with tempfile.TemporaryDirectory() as dir:
+                    try:
+                        storage = make_storage(name, width, dir)
+                    except ModuleNotFoundError as e:
+                        print(f'{name} skipped: {e}', file=sys.stderr)
+                        continue
+                    smartobject.define_storage(storage)
+                    results[f'save/{name}/{case}'] = measure(
+                        lambda o: o.save(force=True), objects, repeat)
+                    results[f'load/{name}/{case}'] = measure(
+                        lambda o: o.load(), objects, repeat)
+                print(f'{name} {case} completed', file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results with baseline
+
+    Returns:
+        list of regressions (name, baseline rate, current rate)
+    """
+    regressions = []
+    print(f'{"benchmark":<44} {"baseline":>12} {"current":>12} {"diff":>8}')
+    for name, rate in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        diff = rate / base - 1
+        mark = ''
+        if diff < -threshold:
+            regressions.append((name, base, rate))
+            mark = ' !'
+        print(f'{name:<44} {round(base):>12} {round(rate):>12} '
+              f'{diff:>+8.1%}{mark}')
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    ap.add_argument('-w',
+                    '--widths',
+                    default='4,16,64',
+                    help='object widths, number of props (default: 4,16,64)')
+    ap.add_argument('-n',
+                    '--counts',
+                    default='100,1000',
+                    help='object counts (default: 100,1000)')
+    ap.add_argument('-s',
+                    '--storages',
+                    default=','.join(STORAGES),
+                    help='storages to test (default: all)')
+    ap.add_argument('-r',
+                    '--repeat',
+                    type=int,
+                    default=3,
+                    help='repeat each test, the best result is taken '
+                    '(default: 3)')
+    ap.add_argument('-o', '--output', help='write results to JSON file')
+    ap.add_argument('-b',
+                    '--baseline',
+                    help='compare results with baseline JSON file')
+    ap.add_argument('-t',
+                    '--threshold',
+                    type=float,
+                    default=0.2,
+                    help='max allowed slowdown vs baseline (default: 0.2)')
+    a = ap.parse_args()
+    results = run([int(w) for w in a.widths.split(',')],
+                  [int(n) for n in a.counts.split(',')],
+                  a.storages.split(','), a.repeat)
+    data = {
+        'smartobject': smartobject.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }
+    if a.output:
+        with open(a.output, 'w') as fh:
+            json.dump(data, fh, indent=2, sort_keys=True)
+    if a.baseline:
+        with open(a.baseline) as fh:
+            baseline = json.load(fh)['results']
+        regressions = compare(results, baseline, a.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression(s) above '
+                  f'{a.threshold:.0%} threshold')
+            sys.exit(1)
+    elif not a.output:
+        print(json.dumps(data, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
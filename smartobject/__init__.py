@@ -4,13 +4,17 @@ from . import config
 
 from .smartobject import SmartObject
 from .factory import SmartObjectFactory
+from .metrics import FactoryMetrics
+from .table import SmartObjectTable
+from .shm import SharedFactory, SharedFactoryReader
 
 from .storage import get_storage, define_storage, purge, DummyStorage
-from .storage import AbstractStorage, AbstractFileStorage
+from .storage import AbstractStorage, AbstractAsyncStorage, AbstractFileStorage
 from .storage import JSONStorage, YAMLStorage
 from .storage import PickleStorage, MessagePackStorage, CBORStorage
 from .storage import SQLAStorage, RedisStorage
 
-from .sync import AbstractSync, DummySync, define_sync, get_sync
+from .sync import AbstractSync, AbstractAsyncSync, DummySync
+from .sync import ProcessSync, define_sync, get_sync
 
 from .constants import SERIALIZE_SAVE, SERIALIZE_SYNC
@@ -0,0 +1,67 @@
+import asyncio
+import inspect
+
+from functools import partial
+
+executor = None
+"""
+Executor for blocking storage and sync calls (default: event loop default
+executor)
+"""
+
+concurrency_limit = 10
+"""
+Default max number of concurrent operations in batch methods
+"""
+
+
+def _blocking_result(result):
+    # checks result of storage or sync method, called from blocking code:
+    # asynchronous backends return awaitables, which would be never awaited
+    if inspect.isawaitable(result):
+        if inspect.iscoroutine(result):
+            result.close()
+        raise RuntimeError('Asynchronous storage or sync can be used with '
+                           'async methods only')
+    return result
+
+
+async def call(method, *args, **kwargs):
+    """
+    Call storage or sync method
+
+    Coroutine functions are awaited, blocking methods are called in executor
+
+    Args:
+        method: storage or sync method
+        *args, **kwargs: method arguments
+    """
+    if inspect.iscoroutinefunction(method):
+        return await method(*args, **kwargs)
+    result = await asyncio.get_running_loop().run_in_executor(
+        executor, partial(method, *args, **kwargs))
+    # wrappers of async methods return awaitables
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+async def gather(aws, limit=None):
+    """
+    Run awaitables concurrently with a concurrency limit
+
+    Args:
+        aws: iterable of coroutines
+        limit: max number of concurrently running coroutines (default:
+            concurrency_limit)
+
+    Returns:
+        list of results, in the same order as awaitables
+    """
+    semaphore = asyncio.Semaphore(limit or concurrency_limit)
+
+    async def run(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*(run(aw) for aw in aws))
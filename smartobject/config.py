@@ -12,3 +12,9 @@ auto_externals = True
 """
 If True, handle getters and setters for external propeties automatically
 """
+
+sync_suppress_unchanged = True
+"""
+If True, props which values are equal to the last synced ones, are not sent
+to synchronizers
+"""
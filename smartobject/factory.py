@@ -1,10 +1,39 @@
 import threading
 import logging
 import time
+import sys
+
+from . import query
+from . import aio
+from .metrics import FactoryMetrics, TimedLock, value_size
+
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from heapq import nlargest
+from itertools import islice
+from operator import itemgetter
 
 logger = logging.getLogger('smartobject')
 
 
+def object_size(obj):
+    """
+    Get approximate object size in bytes
+
+    Default factory sizer. The size is calculated as the sum of sizes of all
+    non-external prop values, including items of lists, tuples, sets and dicts
+
+    Args:
+        obj: Smart Object
+    """
+    size = sys.getsizeof(obj)
+    for prop, p in obj._property_map.items():
+        if not p.get('external'):
+            size += value_size(getattr(obj, prop))
+    return size
+
+
 class SmartObjectFactory:
     """
     Object factory class for Smart Objects
@@ -21,49 +50,148 @@ class SmartObjectFactory:
                 found in storage
             autosave: auto save objects after creation
             maxsize: max number of objects loaded (factory becomes LRU cache)
+            max_bytes: max approximate total size of objects loaded (bytes,
+                factory becomes LRU cache)
+            sizer: function, which returns approximate object size in bytes
+                (default: smartobject.factory.object_size, if max_bytes is
+                set). If specified, the factory keeps total size of objects in
+                "total_bytes" attribute
+            writeback: save modified objects before evicting them from the
+                cache (default: True)
+            ttl: max object age (seconds) in the factory
+            idle_ttl: max time (seconds) since the last object access
+            on_evict: function, called with (obj, reason) arguments when
+                object is evicted from the factory. Reason is "size", "ttl" or
+                "idle"
+            negative_ttl: if set, remember primary keys, not found in storage
+                on auto-load, for the specified time (seconds) and raise
+                exceptions for them without accessing the storage
+            negative_maxsize: max number of primary keys in the negative cache
+                (default: 10000)
+            lock_stripes: number of per-key lock stripes, objects with
+                different primary keys are auto-loaded in parallel (default:
+                64)
+            metrics: collect factory metrics: True or
+                smartobject.metrics.FactoryMetrics object (default: False)
+            versioning: track object changes for factory.changed_since()
+                (default: False)
+            max_changes: max number of object change records, kept if
+                versioning is on (default: 100000)
+
+        The factory counts objects, which were saved on eviction, in
+        "dirty_evictions" attribute and the total time spent on saving them (in
+        seconds) in "flush_time" attribute. Auto-load misses, absorbed by the
+        negative cache, are counted in "negative_hits" attribute.
         """
-        self._objects = {}
-        self._objects_last_access = {}
+        # objects are kept in access order (least recently used first) when
+        # maxsize or max_bytes is set
+        self._objects = OrderedDict()
         self._objects_by_prop = {}
+        # indexed prop values of objects, used to move objects between buckets
+        self._index_values = {}
+        # sorted distinct values of sorted indexes
+        self._sorted_keys = {}
+        # index names (props or tuples of props) which contain prop
+        self._indexes_by_prop = {}
+        self.__index_lock = threading.RLock()
         self._object_class = object_class
+        # the factory lock guards object map, access order and expiry times and
+        # is never held while objects are loaded or saved
         self.__lock = threading.RLock()
+        # per-key locks, striped by primary key hash, and futures of objects
+        # being auto-loaded
+        stripes = kwargs.get('lock_stripes', 64)
+        self._key_locks = [threading.Lock() for _ in range(stripes)]
+        self._loading = [{} for _ in range(stripes)]
         self.autoload = kwargs.get('autoload', False)
         self.autocreate = kwargs.get('autocreate', False)
         self.autosave = kwargs.get('autosave', False)
         self.maxsize = kwargs.get('maxsize')
+        self.max_bytes = kwargs.get('max_bytes')
+        self.sizer = kwargs.get('sizer')
+        if self.sizer is None and self.max_bytes is not None:
+            self.sizer = object_size
+        # object sizes, calculated on create and prop change, if sizer is set
+        self._sizes = {}
+        self.total_bytes = 0
+        self.writeback = kwargs.get('writeback', True)
+        self.ttl = kwargs.get('ttl')
+        self.idle_ttl = kwargs.get('idle_ttl')
+        self.on_evict = kwargs.get('on_evict')
+        # object creation and access times, oldest first
+        self._objects_created = OrderedDict()
+        self._objects_accessed = OrderedDict()
+        self._reaper = None
+        self._reaper_event = None
+        self.negative_ttl = kwargs.get('negative_ttl')
+        self.negative_maxsize = kwargs.get('negative_maxsize', 10000)
+        # primary keys, not found in storage: pk: (expires, exception)
+        self._negative = OrderedDict()
+        self.dirty_evictions = 0
+        self.flush_time = 0
+        self.negative_hits = 0
+        self.versioning = kwargs.get('versioning', False)
+        # factory version, bumped on every object insert and change
+        self.version = 0
+        # latest changes: pk: [version, { prop: version }], oldest first
+        self._changes = OrderedDict()
+        self.max_changes = kwargs.get('max_changes', 100000)
+        # version of the latest dropped change record
+        self._changes_dropped = 0
+        metrics = kwargs.get('metrics')
+        self.metrics = FactoryMetrics() if metrics is True else metrics or None
+        if self.metrics is not None:
+            self.__lock = TimedLock(self.__lock, self.metrics)
 
-    def add_index(self, prop):
+    def add_index(self, prop, sorted=False, composite=False):
         """
         Add index property
 
         The factory can index objects by additional index props.
 
-        Condition using index props:
+        Sorted indexes additionally support range, prefix and top-k queries
+        with factory.find() method. Values of sorted index props must be
+        comparable with each other (props should have "type" defined in
+        property map)
 
-            - prop should be either read-only or not changed after
-              first set
-            - factory index props should be defined before objectas are added
-              to factory
+        Indexes are updated automatically, when indexed props are changed with
+        set_prop() method. If object property is changed directly, the object
+        can be reindexed with factory.reindex() method
 
-        If object property is set after it was added to factory, it can be
-        reindexed with factory.reindex() method
+        If index is added to the factory which already contains objects, the
+        index is built for all of them
+
+        Composite index is built on several props, its keys are tuples of prop
+        values. Objects, which have any of the props set to None, are not
+        indexed. Composite indexes are used by factory.query() or can be
+        queried directly with factory.get(key=(v1, v2), prop=(p1, p2))
 
         Args:
             prop: object prop name or list of prop names
+            sorted: create sorted index (default: False)
+            composite: create single composite index for the list of props
 
         Raises:
-            RuntimeError: if factory already contains objects
             ValueError: if index already defined
         """
+        if composite:
+            props = [tuple(prop)]
+        elif isinstance(prop, list) or isinstance(prop, tuple):
+            props = prop
+        else:
+            props = [prop]
         with self.__lock:
-            for p in prop if isinstance(prop, list) or isinstance(
-                    prop, tuple) else [prop]:
-                if self._objects:
-                    raise RuntimeError('Factory already contains objects')
-                if p not in self._objects_by_prop:
-                    self._objects_by_prop[p] = {}
-                else:
+            for p in props:
+                if p in self._objects_by_prop:
                     raise ValueError('Index already defined')
+                with self.__index_lock:
+                    self._objects_by_prop[p] = {}
+                    if sorted:
+                        self._sorted_keys[p] = []
+                    for i in p if composite else [p]:
+                        self._indexes_by_prop.setdefault(i, []).append(p)
+                    for obj in self._objects.values():
+                        self._update_index(obj, p)
 
     def create(self, opts={}, obj=None, load=False, save=None, override=False):
         """
@@ -86,20 +214,73 @@ class SmartObjectFactory:
             obj.load()
         if (self.autosave and save is not False) or save:
             obj.save()
-        pk = obj._get_primary_key()
-        if pk is None:
-            raise ValueError('Object has no primary key')
-        if self.maxsize != 0:
-            with self.__lock:
-                if pk in self._objects and not override:
-                    raise RuntimeError(f'Object already exists: {pk}')
+        self._append_many([obj], override=override)
+        logger.debug(
+            f'+ object {self._object_class.__name__} {obj._get_primary_key()}')
+        return obj
+
+    def _append_many(self, objects, override=False, _purge=True):
+        # insert objects with a single factory lock and purge the cache once
+        pks = []
+        for obj in objects:
+            pk = obj._get_primary_key()
+            if pk is None:
+                raise ValueError('Object has no primary key')
+            pks.append(pk)
+        sizes = [self.sizer(obj) for obj in objects
+                ] if self.sizer is not None else None
+        with self.__lock:
+            if self.negative_ttl is not None:
+                for pk in pks:
+                    self._negative.pop(pk, None)
+            if self.maxsize == 0:
+                return
+            if not override:
+                for pk, obj in zip(pks, objects):
+                    old_obj = self._objects.get(pk)
+                    if old_obj is not None and old_obj is not obj:
+                        raise RuntimeError(f'Object already exists: {pk}')
+            now = time.monotonic()
+            lru = self.maxsize is not None or self.max_bytes is not None
+            inserted = 0
+            for i, (pk, obj) in enumerate(zip(pks, objects)):
+                old_obj = self._objects.get(pk)
+                if old_obj is not obj:
+                    inserted += 1
+                    if old_obj is not None:
+                        self._unindex(old_obj)
+                        old_obj._object_factory = None
                 self._objects[pk] = obj
-                self._objects_last_access[pk] = time.perf_counter()
-                self.reindex(pk)
+                if lru:
+                    self._objects.move_to_end(pk)
+                if sizes is not None:
+                    self.total_bytes += sizes[i] - self._sizes.get(pk, 0)
+                    self._sizes[pk] = sizes[i]
+                if self.versioning:
+                    self.version += 1
+                    self._changes.pop(pk, None)
+                    self._changes[pk] = [
+                        self.version,
+                        dict.fromkeys(
+                            (p for p, v in obj._property_map.items()
+                             if not v.get('external')), self.version)
+                    ]
+                    self._trim_changes()
+                for ttl, times in ((self.ttl, self._objects_created),
+                                   (self.idle_ttl, self._objects_accessed)):
+                    if ttl is not None:
+                        times[pk] = now
+                        times.move_to_end(pk)
                 obj._object_factory = self
-                self.purge()
-                logger.debug(f'+ object {self._object_class.__name__} {pk}')
-        return obj
+            if self._objects_by_prop:
+                with self.__index_lock:
+                    for obj in objects:
+                        for p in self._objects_by_prop:
+                            self._update_index(obj, p)
+        if self.metrics is not None and inserted:
+            self.metrics.inc('creates', inserted)
+        if _purge:
+            self.purge()
 
     def reindex(self, obj):
         """
@@ -108,13 +289,146 @@ class SmartObjectFactory:
         Args:
             obj: object or object primary key, required
         """
+        # the object is got before locking the factory, as get() may
+        # auto-load it or evict expired objects
+        if not isinstance(obj, self._object_class):
+            obj = self.get(obj)
         with self.__lock:
-            if not isinstance(obj, self._object_class):
-                obj = self.get(obj)
-            for p in self._objects_by_prop:
-                val = getattr(obj, p)
-                if val is not None:
-                    self._objects_by_prop[p].setdefault(val, set()).add(obj)
+            with self.__index_lock:
+                for p in self._objects_by_prop:
+                    self._update_index(obj, p)
+
+    def _update_index(self, obj, prop):
+        values = self._index_values.setdefault(obj, {})
+        old_value = values.get(prop)
+        if isinstance(prop, tuple):
+            value = tuple(getattr(obj, p) for p in prop)
+            if None in value:
+                value = None
+        else:
+            value = getattr(obj, prop)
+        if value == old_value:
+            return
+        if old_value is not None:
+            self._unindex_value(prop, old_value, obj)
+        if value is None:
+            del values[prop]
+        else:
+            index = self._objects_by_prop[prop]
+            bucket = index.get(value)
+            if bucket is None:
+                keys = self._sorted_keys.get(prop)
+                if keys is not None:
+                    insort(keys, value)
+                bucket = index[value] = set()
+            bucket.add(obj)
+            values[prop] = value
+
+    def _unindex_value(self, prop, value, obj):
+        index = self._objects_by_prop[prop]
+        bucket = index.get(value)
+        if bucket is not None:
+            bucket.discard(obj)
+            if not bucket:
+                del index[value]
+                keys = self._sorted_keys.get(prop)
+                if keys is not None:
+                    del keys[bisect_left(keys, value)]
+
+    def _unindex(self, obj):
+        with self.__index_lock:
+            for p, val in self._index_values.pop(obj, {}).items():
+                self._unindex_value(p, val, obj)
+
+    def _on_prop_changed(self, obj, prop, old_value):
+        """
+        Called by objects when their property value is changed
+        """
+        indexes = self._indexes_by_prop.get(prop)
+        if indexes:
+            with self.__index_lock:
+                if obj in self._index_values:
+                    for p in indexes:
+                        self._update_index(obj, p)
+        if self.sizer is not None:
+            # the cache is purged on the next insert, objects aren't evicted
+            # while being modified
+            size = self.sizer(obj)
+            with self.__lock:
+                pk = obj._get_primary_key()
+                if self._objects.get(pk) is obj:
+                    self.total_bytes += size - self._sizes.get(pk, 0)
+                    self._sizes[pk] = size
+        if self.versioning:
+            with self.__lock:
+                pk = obj._get_primary_key()
+                if self._objects.get(pk) is obj:
+                    self.version += 1
+                    change = self._changes.get(pk)
+                    if change is None:
+                        change = self._changes[pk] = [0, {}]
+                    else:
+                        self._changes.move_to_end(pk)
+                    change[0] = self.version
+                    change[1][prop] = self.version
+                    self._trim_changes()
+
+    def _trim_changes(self):
+        # drop the oldest change records, called under the factory lock
+        while len(self._changes) > self.max_changes:
+            _, (v, _) = self._changes.popitem(last=False)
+            self._changes_dropped = v
+
+    def changed_since(self, version):
+        """
+        Get objects changed since the specified factory version
+
+        Requires factory versioning to be enabled. Objects, inserted into the
+        factory, are reported with all props changed, objects deleted with
+        factory.delete() are reported with props=None
+
+        Args:
+            version: factory version (e.g. factory.version value, got during
+                the previous call)
+
+        Returns:
+            list of tuples (pk, set of changed props, object version), ordered
+            by object version
+
+        Raises:
+            LookupError: if change records since the version are dropped (see
+                max_changes factory argument), full resync is required
+        """
+        result = []
+        with self.__lock:
+            if version < self._changes_dropped:
+                raise LookupError(
+                    f'Changes since version {version} are dropped, full '
+                    'resync is required')
+            for pk in reversed(self._changes):
+                v, props = self._changes[pk]
+                if v <= version:
+                    break
+                result.append((pk, None if props is None else
+                               {p for p, pv in props.items() if pv > version},
+                               v))
+        result.reverse()
+        return result
+
+    def get_version(self, pk):
+        """
+        Get object version
+
+        Args:
+            pk: object primary key
+
+        Returns:
+            factory version of the latest object change or None, if the object
+            is not tracked
+        """
+        with self.__lock:
+            change = self._changes.get(pk)
+            return None if change is None else change[0]
 
     def append(self, obj, load=False, save=None, override=False):
         """
@@ -137,10 +451,19 @@ class SmartObjectFactory:
         Args:
             obj: object or object primary key, required
         """
+        if self.maxsize is None and self.max_bytes is None and \
+                self.idle_ttl is None:
+            return
         with self.__lock:
             if isinstance(obj, self._object_class):
                 obj = obj._get_primary_key()
-            self._objects_last_access[obj] = time.perf_counter()
+            if obj not in self._objects:
+                return
+            if self.maxsize is not None or self.max_bytes is not None:
+                self._objects.move_to_end(obj)
+            if self.idle_ttl is not None:
+                self._objects_accessed[obj] = time.monotonic()
+                self._objects_accessed.move_to_end(obj)
 
     def get(self, key=None, prop=None, storage_id=None, get_all=False, opts={}):
         """
@@ -165,58 +488,615 @@ class SmartObjectFactory:
             For primary key: single object is returned. For another prop: list
             of objects. The list can be empty
         """
-        with self.__lock:
-            if not key:
+        if not key:
+            with self.__lock:
                 return self._objects.copy()
-            elif prop is not None:
-                result = []
-                if not get_all:
-                    for obj in self._objects_by_prop[prop][key]:
-                        self.touch(obj)
-                        result.append(obj)
-                if self.autoload and (get_all or not result):
-                    from . import storage
-                    try:
-                        objects = storage.get_storage(storage_id).load_by_prop(
-                            key, prop)
-                    except RuntimeError:
-                        objects = []
-                    for d in objects:
-                        if 'data' in d:
-                            logger.debug(
-                                f'Creating object {self._object_class.__name__}'
-                            )
-                            o = self._object_class(**opts)
-                            o.set_prop(d['data'],
-                                       _allow_readonly=True,
-                                       sync=False,
-                                       save=False)
-                            o.after_load(opts=d.get('info', {}))
-                            o.sync()
-                            if o._get_primary_key() not in self._objects:
-                                self.create(obj=o, save=False)
-                            result.append(o)
-                return result
-            else:
+        elif prop is not None:
+            result = []
+            if not get_all:
+                if isinstance(prop, list):
+                    prop = tuple(prop)
+                index = self._objects_by_prop[prop]
+                with self.__index_lock:
+                    result = list(index.get(key, ()))
+                result = self._touch_alive(result)
+                if self.metrics is not None:
+                    self.metrics.inc('prop_hits' if result else 'prop_misses')
+            if self.autoload and (get_all or not result):
+                from . import storage
                 try:
-                    obj = self._objects[key]
-                    self.touch(obj)
-                    return obj
-                except KeyError:
-                    if self.autoload:
-                        obj = self._object_class(**opts)
-                        obj._set_primary_key(key)
+                    objects = aio._blocking_result(
+                        storage.get_storage(storage_id).load_by_prop(
+                            key, prop))
+                except RuntimeError:
+                    objects = []
+                for d in objects:
+                    if 'data' in d:
+                        logger.debug(
+                            f'Creating object {self._object_class.__name__}')
+                        o = self._object_class(**opts)
+                        o.set_prop(d['data'],
+                                   _allow_readonly=True,
+                                   sync=False,
+                                   save=False)
+                        o.after_load(opts=d.get('info', {}))
+                        o.sync()
+                        # the factory lock is not held here, as inserting
+                        # can evict and save other objects
                         try:
-                            obj.load()
-                        except (FileNotFoundError, LookupError):
-                            if self.autocreate:
-                                pass
-                            else:
-                                raise
+                            self.create(obj=o, save=False)
+                        except RuntimeError:
+                            # the object is already in factory
+                            o = self._get_alive(o._get_primary_key()) or o
+                        result.append(o)
+            return result
+        else:
+            obj = self._get_alive(key)
+            if self.metrics is not None:
+                self.metrics.inc('misses' if obj is None else 'hits')
+            if obj is not None:
+                return obj
+            elif not self.autoload:
+                raise KeyError(key)
+            return self._autoload(key, opts)
+
+    def get_many(self, pks, missing=None, opts={}):
+        """
+        Get multiple Smart Objects from factory
+
+        If auto-load is on, objects, missing in factory, are loaded with a
+        single batch call per storage (see AbstractStorage.load_many)
+
+        Args:
+            pks: list of object primary keys
+            missing: what to do with objects, not found in factory (and in
+                storage if auto-load is on): "skip", "raise" or "create".
+                Default: "create" if factory autocreate is on, otherwise
+                "skip"
+            opts: options for object constructor if loaded from storage
+
+        Raises:
+            KeyError: if missing="raise" and some objects are not found, the
+                exception argument is the list of missing primary keys
+
+        Returns:
+            dict { pk: object }
+        """
+        if missing is None:
+            missing = 'create' if self.autocreate else 'skip'
+        elif missing not in ('skip', 'raise', 'create'):
+            raise ValueError(f'invalid value: missing="{missing}"')
+        pks = list(dict.fromkeys(pks))
+        found = []
+        with self.__lock:
+            for pk in pks:
+                obj = self._objects.get(pk)
+                if obj is not None:
+                    found.append(obj)
+        result = {
+            obj._get_primary_key(): obj for obj in self._touch_alive(found)
+        }
+        misses = [pk for pk in pks if pk not in result]
+        if self.metrics is not None:
+            self.metrics.inc('hits', len(result))
+            self.metrics.inc('misses', len(misses))
+        if misses and self.autoload:
+            misses = self._autoload_many(misses, missing == 'create', opts,
+                                         result)
+        if misses:
+            if missing == 'raise':
+                raise KeyError(misses)
+            elif missing == 'create':
+                for pk in misses:
+                    obj = self._object_class(**opts)
+                    obj._set_primary_key(pk)
+                    result[pk] = self.append(obj)
+        return result
+
+    def _autoload_many(self, pks, create, opts, result):
+        # the same single-flight protocol as _autoload, returns missing pks
+        owned = {}
+        waiting = {}
+        missing = []
+        for pk in pks:
+            stripe = hash(pk) % len(self._key_locks)
+            loading = self._loading[stripe]
+            with self._key_locks[stripe]:
+                future = loading.get(pk)
+                if future is not None:
+                    waiting[pk] = future
+                    continue
+                obj = self._get_alive(pk)
+                if obj is not None:
+                    result[pk] = obj
+                elif not create and self._check_negative(pk) is not None:
+                    missing.append(pk)
+                else:
+                    owned[pk] = loading[pk] = Future()
+        try:
+            t_start = time.perf_counter()
+            loaded = self._load_objects(list(owned), opts)
+            if self.metrics is not None and owned:
+                self.metrics.observe('autoload_time',
+                                     time.perf_counter() - t_start)
+                self.metrics.inc('autoloads', len(loaded))
+                self.metrics.inc('autoload_errors', len(owned) - len(loaded))
+            for pk, future in owned.items():
+                obj = loaded.get(pk)
+                if obj is None and create:
+                    obj = self._object_class(**opts)
+                    obj._set_primary_key(pk)
+                if obj is None:
+                    e = KeyError(pk)
+                    if self.negative_ttl is not None:
+                        self._add_negative(pk, e)
+                    future.set_exception(e)
+                    missing.append(pk)
+                else:
+                    self.append(obj)
+                    future.set_result(obj)
+                    result[pk] = obj
+        except BaseException as e:
+            for future in owned.values():
+                if not future.done():
+                    future.set_exception(e)
+            raise
+        finally:
+            for pk in owned:
+                stripe = hash(pk) % len(self._key_locks)
+                with self._key_locks[stripe]:
+                    del self._loading[stripe][pk]
+        for pk, future in waiting.items():
+            try:
+                result[pk] = future.result()
+            except (FileNotFoundError, LookupError):
+                missing.append(pk)
+        return missing
+
+    def _load_objects(self, pks, opts):
+        # load objects with a single storage call per storage, returns dict of
+        # objects found in all storages
+        from . import storage
+        objects = {}
+        for pk in pks:
+            obj = self._object_class(**opts)
+            obj._set_primary_key(pk)
+            objects[pk] = obj
+        if not objects:
+            return objects
+        data = {}
+        for storage_id in next(iter(objects.values()))._get_storages():
+            s = storage.get_storage(storage_id)
+            if hasattr(s, 'load_many'):
+                d = aio._blocking_result(s.load_many(list(objects)))
+            else:
+                d = {}
+                for pk in objects:
+                    try:
+                        d[pk] = aio._blocking_result(s.load(pk))
+                    except (FileNotFoundError, LookupError):
+                        pass
+            for pk in list(objects):
+                if pk in d:
+                    data.setdefault(pk, {})[storage_id] = d[pk]
+                else:
+                    del objects[pk]
+        for pk, obj in objects.items():
+            obj.load(_data=data.get(pk, {}))
+        return objects
+
+    def _check_negative(self, pk):
+        # returns exception if pk is in negative cache
+        if self.negative_ttl is None:
+            return None
+        with self.__lock:
+            try:
+                expires, e = self._negative[pk]
+            except KeyError:
+                return None
+            if expires > time.monotonic():
+                self.negative_hits += 1
+                return e
+            del self._negative[pk]
+
+    def _autoload(self, key, opts):
+        obj, future, owner = self._begin_autoload(key)
+        if obj is not None:
+            return obj
+        elif not owner:
+            return future.result()
+        try:
+            obj = self._object_class(**opts)
+            obj._set_primary_key(key)
+            t_start = time.perf_counter()
+            try:
+                obj.load()
+            except (FileNotFoundError, LookupError) as e:
+                self._autoload_not_found(key, e)
+            finally:
+                if self.metrics is not None:
+                    self.metrics.observe('autoload_time',
+                                         time.perf_counter() - t_start)
+        except BaseException as e:
+            self._end_autoload(key, future, e=e)
+            raise
+        return self._end_autoload(key, future, obj=obj)
+
+    async def async_get(self, key, opts={}):
+        """
+        Get Smart Object from factory by primary key, asyncio version
+
+        If auto-load is on, missing object is loaded with
+        SmartObject.async_load(). The object is loaded once, concurrent
+        callers (coroutines and threads) wait for the result
+
+        Args:
+            key: object primary key
+            opts: options for object constructor if loaded from storage
+        Raises:
+            KeyError: if object with such key doesn't exist
+            FileNotFoundError, LookupError: if auto-load is on but object not
+                found in storage
+
+        Returns:
+            Smart Object
+        """
+        obj = await self._async_get_alive(key)
+        if self.metrics is not None:
+            self.metrics.inc('misses' if obj is None else 'hits')
+        if obj is not None:
+            return obj
+        elif not self.autoload:
+            raise KeyError(key)
+        obj, future, owner = self._begin_autoload(key)
+        if obj is not None:
+            return obj
+        elif not owner:
+            import asyncio
+            return await asyncio.wrap_future(future)
+        try:
+            obj = self._object_class(**opts)
+            obj._set_primary_key(key)
+            t_start = time.perf_counter()
+            try:
+                await obj.async_load()
+            except (FileNotFoundError, LookupError) as e:
+                self._autoload_not_found(key, e)
+            finally:
+                if self.metrics is not None:
+                    self.metrics.observe('autoload_time',
+                                         time.perf_counter() - t_start)
+        except BaseException as e:
+            self._end_autoload(key, future, e=e)
+            raise
+        obj = self._end_autoload(key, future, obj=obj, purge=False)
+        # dirty objects are saved with async methods before eviction
+        await self.async_purge()
+        return obj
+
+    async def async_get_many(self, pks, opts={}, limit=None):
+        """
+        Get multiple Smart Objects from factory, asyncio version
+
+        Objects, missing in factory, are auto-loaded concurrently
+
+        Args:
+            pks: list of object primary keys
+            opts: options for object constructor if loaded from storage
+            limit: max number of concurrent loads (default:
+                aio.concurrency_limit)
+        Raises:
+            KeyError, FileNotFoundError, LookupError: as async_get()
+
+        Returns:
+            dict { pk: object }
+        """
+        pks = list(dict.fromkeys(pks))
+        objects = await aio.gather((self.async_get(pk, opts) for pk in pks),
+                                   limit=limit)
+        return dict(zip(pks, objects))
+
+    def _begin_autoload(self, key):
+        # the object is loaded once, concurrent callers wait for the result.
+        # returns tuple (obj, future, owner), obj is set if the object has
+        # been already loaded by another caller
+        e = self._check_negative(key)
+        if e is not None:
+            raise e.__class__(*e.args)
+        stripe = hash(key) % len(self._key_locks)
+        loading = self._loading[stripe]
+        with self._key_locks[stripe]:
+            future = loading.get(key)
+            if future is not None:
+                return None, future, False
+            # the object could be loaded by another thread
+            obj = self._get_alive(key)
+            if obj is not None:
+                return obj, None, False
+            future = loading[key] = Future()
+            return None, future, True
+
+    def _autoload_not_found(self, key, e):
+        if not self.autocreate:
+            if self.negative_ttl is not None:
+                self._add_negative(key, e)
+            raise e
+
+    def _end_autoload(self, key, future, obj=None, e=None, purge=True):
+        # if purge is False, the caller must purge the cache
+        stripe = hash(key) % len(self._key_locks)
+        try:
+            if e is None:
+                try:
+                    if purge:
                         self.append(obj)
-                        return obj
                     else:
-                        raise
+                        self._append_many([obj], _purge=False)
+                except BaseException as exc:
+                    e = exc
+                    raise
+                if self.metrics is not None:
+                    self.metrics.inc('autoloads')
+                future.set_result(obj)
+                return obj
+        finally:
+            if e is not None:
+                if self.metrics is not None:
+                    self.metrics.inc('autoload_errors')
+                future.set_exception(e)
+            with self._key_locks[stripe]:
+                del self._loading[stripe][key]
+
+    def _add_negative(self, pk, e):
+        with self.__lock:
+            self._negative[pk] = (time.monotonic() + self.negative_ttl, e)
+            self._negative.move_to_end(pk)
+            while len(self._negative) > self.negative_maxsize:
+                self._negative.popitem(last=False)
+
+    def _get_alive(self, pk):
+        with self.__lock:
+            obj = self._objects.get(pk)
+            if obj is None:
+                return None
+            if self.ttl is None and self.idle_ttl is None:
+                self.touch(obj)
+                return obj
+        return (self._touch_alive([obj]) or [None])[0]
+
+    async def _async_get_alive(self, pk):
+        with self.__lock:
+            obj = self._objects.get(pk)
+            if obj is None:
+                return None
+            if self.ttl is None and self.idle_ttl is None:
+                self.touch(obj)
+                return obj
+        return (await self._async_touch_alive([obj]) or [None])[0]
+
+    def _touch_alive(self, objects):
+        # evict expired objects from the list, touch others
+        expired = self._get_expired_objects(objects)
+        if not expired:
+            return objects
+        evicted = set()
+        for reason, objs in expired.items():
+            evicted.update(self._evict(objs, reason))
+        return self._touch_not_evicted(objects, evicted)
+
+    async def _async_touch_alive(self, objects):
+        expired = self._get_expired_objects(objects)
+        if not expired:
+            return objects
+        evicted = set()
+        for reason, objs in expired.items():
+            evicted.update(await self._async_evict(objs, reason))
+        return self._touch_not_evicted(objects, evicted)
+
+    def _get_expired_objects(self, objects):
+        # returns expired objects { reason: objects }, if there are no expired
+        # objects, touches all
+        expired = {}
+        with self.__lock:
+            if self.ttl is not None or self.idle_ttl is not None:
+                now = time.monotonic()
+                for obj in objects:
+                    reason = self._get_expired(obj._get_primary_key(), now)
+                    if reason is not None:
+                        expired.setdefault(reason, []).append(obj)
+            if not expired:
+                for obj in objects:
+                    self.touch(obj)
+        return expired
+
+    def _touch_not_evicted(self, objects, evicted):
+        result = [obj for obj in objects if obj not in evicted]
+        with self.__lock:
+            for obj in result:
+                self.touch(obj)
+        return result
+
+    def find(self,
+             prop,
+             gt=None,
+             ge=None,
+             lt=None,
+             le=None,
+             prefix=None,
+             limit=None,
+             reverse=False):
+        """
+        Find objects in factory by sorted index
+
+        Args:
+            prop: object prop (should have sorted index)
+            gt: prop value is greater than
+            ge: prop value is greater than or equal to
+            lt: prop value is less than
+            le: prop value is less than or equal to
+            prefix: prop value starts with (for str and bytes values)
+            limit: max number of objects to return
+            reverse: return objects in descending order of prop value, e.g.
+                reverse=True + limit=10 returns top-10 objects
+
+        Returns:
+            list of objects, sorted by prop value. The list can be empty
+
+        Raises:
+            ValueError: if prop has no sorted index
+        """
+        try:
+            keys = self._sorted_keys[prop]
+        except KeyError:
+            raise ValueError(f'No sorted index for "{prop}"')
+        index = self._objects_by_prop[prop]
+        result = []
+        with self.__index_lock:
+            lo, hi = self._sorted_range(keys, gt, ge, lt, le, prefix)
+            for i in reversed(range(lo, hi)) if reverse else range(lo, hi):
+                result.extend(index[keys[i]])
+                if limit is not None and len(result) >= limit:
+                    del result[limit:]
+                    break
+        return self._touch_alive(result)
+
+    @staticmethod
+    def _sorted_range(keys, gt=None, ge=None, lt=None, le=None, prefix=None):
+        lo = 0
+        hi = len(keys)
+        if ge is not None:
+            lo = max(lo, bisect_left(keys, ge))
+        if gt is not None:
+            lo = max(lo, bisect_right(keys, gt))
+        if le is not None:
+            hi = min(hi, bisect_right(keys, le))
+        if lt is not None:
+            hi = min(hi, bisect_left(keys, lt))
+        if prefix is not None:
+            lo = max(lo, bisect_left(keys, prefix))
+            end = lo
+            while end < hi and keys[end].startswith(prefix):
+                end += 1
+            hi = end
+        return lo, hi
+
+    def query(self, where, limit=None):
+        """
+        Query objects in factory
+
+        Conditions are combined with logical AND. The query planner picks the
+        most selective index, intersects it with other indexes if they are
+        selective enough and filters the remaining candidates. If no index can
+        be used, all objects in factory are scanned.
+
+        Example:
+
+            factory.query({
+                'model': 'x1',
+                'battery': {'lt': 20},
+                'status': {'nin': ['offline', 'disabled']}
+            })
+
+        Args:
+            where: dict { prop: value } or { prop: { op: value } }, where op is
+                one of: eq, ne, in, nin (not in), gt, ge, lt, le, prefix. Range
+                operators and prefix can use sorted indexes only
+            limit: max number of objects to return
+
+        Returns:
+            list of objects, unordered. The list can be empty
+        """
+        predicates = query.parse(where)
+        with self.__lock:
+            candidates, _ = self._plan_query(predicates)
+        result = []
+        for obj in candidates:
+            if all(p.match(obj) for p in predicates):
+                result.append(obj)
+                if limit is not None and len(result) >= limit:
+                    break
+        return self._touch_alive(result)
+
+    def explain(self, where):
+        """
+        Explain query plan
+
+        Args:
+            where: query conditions, same as for factory.query()
+
+        Returns:
+            dict with fields:
+                indexes: list of indexes used (index name, predicates, number
+                    of objects)
+                scan: True if all objects in factory are scanned
+                candidates: number of objects to filter
+                filter: predicates, objects are filtered with
+        """
+        predicates = query.parse(where)
+        with self.__lock:
+            candidates, plan = self._plan_query(predicates)
+            plan['candidates'] = len(candidates)
+            plan['filter'] = [str(p) for p in predicates]
+            return plan
+
+    def _plan_query(self, predicates):
+        paths = []
+        eqs = {p.prop: p.value for p in predicates if p.op == 'eq'}
+        ranges = {}
+        with self.__index_lock:
+            for p in predicates:
+                index = self._objects_by_prop.get(p.prop)
+                if index is None:
+                    continue
+                # None values are not indexed
+                if p.op == 'eq' and p.value is not None:
+                    buckets = [index.get(p.value, ())]
+                elif p.op == 'in' and None not in p.value:
+                    buckets = [index.get(v, ()) for v in p.value]
+                elif p.op in query.RANGE_OPS and p.prop in self._sorted_keys:
+                    ranges.setdefault(p.prop, []).append(p)
+                    continue
+                else:
+                    continue
+                paths.append((p.prop, [p], buckets))
+            for prop, preds in ranges.items():
+                keys = self._sorted_keys[prop]
+                lo, hi = self._sorted_range(keys,
+                                            **{p.op: p.value for p in preds})
+                index = self._objects_by_prop[prop]
+                paths.append(
+                    (prop, preds, [index[keys[i]] for i in range(lo, hi)]))
+            for name, index in self._objects_by_prop.items():
+                if isinstance(name, tuple) and all(
+                        eqs.get(i) is not None for i in name):
+                    paths.append(
+                        (name, [p for p in predicates if p.op == 'eq'
+                                and p.prop in name],
+                         [index.get(tuple(eqs[i] for i in name), ())]))
+            paths = sorted(
+                ((name, preds, buckets, sum(len(b) for b in buckets))
+                 for name, preds, buckets in paths),
+                key=lambda x: x[3])
+            plan = {'indexes': [], 'scan': not paths}
+            if paths:
+                candidates = None
+                for name, preds, buckets, size in paths:
+                    if candidates is not None and (
+                            not candidates or
+                            size > len(candidates) * query.INTERSECT_RATIO):
+                        break
+                    objects = set().union(*buckets)
+                    if candidates is None:
+                        candidates = objects
+                    else:
+                        candidates &= objects
+                    plan['indexes'].append({
+                        'index': name,
+                        'predicates': [str(p) for p in preds],
+                        'objects': size
+                    })
+                return list(candidates), plan
+        return list(self._objects.values()), plan
 
     def load(self, pk=None):
         """
@@ -227,8 +1107,7 @@ class SmartObjectFactory:
                 for all objects in factory
         """
         if pk:
-            with self.__lock:
-                self.get(pk).load()
+            self.get(pk).load()
         else:
             for i, o in self.get().items():
                 o.load()
@@ -244,19 +1123,407 @@ class SmartObjectFactory:
             **kwargs: passed to object constructor as kwargs
         """
         from . import storage
-        with self.__lock:
-            for d in storage.get_storage(storage_id).load_all(**load_opts):
+        for d in storage.get_storage(storage_id).load_all(**load_opts):
+            if 'data' in d:
+                logger.debug(f'Creating object {self._object_class.__name__}')
+                o = self._object_class(**opts)
+                o.set_prop(d['data'],
+                           _allow_readonly=True,
+                           sync=False,
+                           save=False)
+                o.after_load(opts=d.get('info', {}))
+                o.sync()
+                self.create(obj=o, override=override, save=False)
+
+    def warmup(self,
+               storage_id=None,
+               load_opts={},
+               override=False,
+               opts={},
+               workers=1,
+               chunk_size=1000,
+               sync=False,
+               progress=None,
+               progress_interval=1):
+        """
+        Load all objects from specified storage in parallel
+
+        Faster alternative of load_all(): objects are built in worker threads,
+        while the storage is being read, and inserted into the factory in
+        chunks, with a single factory lock and index update per chunk. Objects
+        are not synced by default.
+
+        Building objects is CPU-bound, so more workers help only if the
+        storage is slow (e.g. remote database) or with free-threaded Python.
+        File-based storages can also read and decode files in parallel with
+        load_opts={'workers': N}
+
+        Args:
+            storage_id: storage ID
+            load_opts: dict of kwargs, passed to storage.load_all() method
+            override: allow overriding existing objects
+            opts: passed to object constructor as kwargs
+            workers: number of worker threads (default: 1)
+            chunk_size: number of objects processed by a worker at once
+            sync: sync objects after loading (default: False)
+            progress: function, called every progress_interval seconds and
+                after loading is completed, with arguments (loaded, total,
+                rate, eta), where total (number of objects in storage) and eta
+                (seconds) are None if the storage can not count objects
+            progress_interval: progress report interval (seconds)
+
+        Returns:
+            number of objects loaded
+        """
+        from . import storage
+        from concurrent.futures import ThreadPoolExecutor
+        s = storage.get_storage(storage_id)
+        # duck-typed storages may have no count() method
+        count = getattr(s, 'count', None)
+        total = count(**load_opts) if progress and count else None
+        loaded = 0
+        t_start = time.perf_counter()
+        t_report = t_start
+
+        def build(chunk):
+            result = []
+            for d in chunk:
                 if 'data' in d:
-                    logger.debug(
-                        f'Creating object {self._object_class.__name__}')
                     o = self._object_class(**opts)
                     o.set_prop(d['data'],
                                _allow_readonly=True,
                                sync=False,
                                save=False)
                     o.after_load(opts=d.get('info', {}))
-                    o.sync()
-                    self.create(obj=o, override=override, save=False)
+                    if sync:
+                        o.sync()
+                    result.append(o)
+            return result
+
+        def report():
+            t = time.perf_counter() - t_start
+            rate = loaded / t if t else 0
+            eta = (total - loaded) / rate if total is not None and rate \
+                    else None
+            progress(loaded, total, rate, eta)
+
+        logger.debug(f'Warming up {self._object_class.__name__} factory')
+        with ThreadPoolExecutor(workers) as pool:
+            pending = deque()
+            data = iter(s.load_all(**load_opts))
+            while True:
+                chunk = list(islice(data, chunk_size))
+                if chunk:
+                    pending.append(pool.submit(build, chunk))
+                # keep workers busy but don't read the whole storage ahead
+                while pending and (len(pending) > workers or not chunk):
+                    objects = pending.popleft().result()
+                    self._append_many(objects, override=override)
+                    loaded += len(objects)
+                    if progress and time.perf_counter(
+                    ) - t_report >= progress_interval:
+                        t_report = time.perf_counter()
+                        report()
+                if not chunk:
+                    break
+        if progress:
+            report()
+        logger.debug(f'{self._object_class.__name__} {loaded} objects loaded')
+        return loaded
+
+    def dump_snapshot(self, path):
+        """
+        Dump all factory objects into binary snapshot file
+
+        Snapshot contains raw values of all non-external object props, names
+        of modified props and index definitions. The file is written with
+        pickle protocol 5 and replaced atomically.
+
+        Args:
+            path: snapshot file path
+
+        Returns:
+            number of objects dumped
+        """
+        import os
+        import pickle
+        with self.__lock:
+            objects = list(self._objects.values())
+        with self.__index_lock:
+            indexes = [(p, p in self._sorted_keys)
+                       for p in self._objects_by_prop]
+        if objects:
+            pmap = objects[0]._property_map
+            props = [p for p, v in pmap.items() if not v.get('external')]
+            map_hash = objects[0]._get_property_map_hash()
+        else:
+            props = []
+            map_hash = None
+        rows = []
+        for obj in objects:
+            modified = obj._get_modified_props()
+            rows.append((tuple(getattr(obj, p) for p in props),
+                         tuple(modified) if modified else None))
+        snapshot = {
+            'version': 1,
+            'class': self._object_class.__name__,
+            'map_hash': map_hash,
+            'props': props,
+            'indexes': indexes,
+            'objects': rows
+        }
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as fh:
+            pickle.dump(snapshot, fh, protocol=5)
+        os.replace(tmp, path)
+        logger.debug(f'{self._object_class.__name__} {len(rows)} objects '
+                     f'dumped to {path}')
+        return len(rows)
+
+    def restore_snapshot(self, path, override=False, opts={}):
+        """
+        Restore factory objects from binary snapshot file
+
+        If the property map of the object class is not changed since the
+        snapshot was dumped, prop values are restored as-is, without
+        validation, otherwise they are set with set_prop() and props, which
+        are no longer in the map, are skipped. Restored objects are neither
+        saved nor synced, after_load() is not called. Missing indexes,
+        defined in the snapshot, are added to the factory.
+
+        Args:
+            path: snapshot file path
+            override: allow overriding existing objects
+            opts: passed to object constructor as kwargs
+
+        Returns:
+            number of objects restored
+        """
+        import mmap
+        import pickle
+        with open(path, 'rb') as fh:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                snapshot = pickle.loads(m)
+        if snapshot.get('version') != 1:
+            raise ValueError(f'unsupported snapshot version: {path}')
+        props = snapshot['props']
+        objects = []
+        same_map = None
+        for values, modified in snapshot['objects']:
+            o = self._object_class(**opts)
+            if same_map is None:
+                same_map = o._get_property_map_hash() == snapshot['map_hash']
+            if same_map:
+                o._restore_values(dict(zip(props, values)), modified or ())
+            else:
+                o.set_prop(
+                    {
+                        p: v
+                        for p, v in zip(props, values)
+                        if p in o._property_map
+                    },
+                    _allow_readonly=True,
+                    sync=False,
+                    save=False)
+            objects.append(o)
+        for index, is_sorted in snapshot['indexes']:
+            if index not in self._objects_by_prop:
+                if isinstance(index, tuple):
+                    self.add_index(list(index),
+                                   sorted=is_sorted,
+                                   composite=True)
+                else:
+                    self.add_index(index, sorted=is_sorted)
+        self._append_many(objects, override=override)
+        logger.debug(f'{self._object_class.__name__} {len(objects)} objects '
+                     f'restored from {path}')
+        return len(objects)
+
+    def export(self,
+               stream,
+               mode=None,
+               format='ndjson',
+               chunk_size=1000,
+               allow_deleted=False):
+        """
+        Export serialized objects to stream
+
+        Objects are serialized and written in chunks, so only a chunk of
+        serialized objects is kept in memory. Values, unsupported by the
+        format (e.g. bytes for ndjson), are not converted
+
+        Args:
+            stream: text (ndjson) or binary (msgpack) stream
+            mode: object serialization mode
+            format: ndjson (newline-delimited JSON) or msgpack
+            chunk_size: number of objects serialized and written at once
+            allow_deleted: export deleted objects, which are still in factory
+
+        Returns:
+            number of objects exported
+
+        Raises:
+            TypeError: if serialized objects contain values, unsupported by
+                the format
+        """
+        if format == 'ndjson':
+            import json
+            dumps = lambda d: json.dumps(d) + '\n'
+            join = ''.join
+        elif format == 'msgpack':
+            import importlib
+            dumps = importlib.import_module('msgpack').Packer().pack
+            join = b''.join
+        else:
+            raise ValueError(f'unsupported format: {format}')
+        with self.__lock:
+            pks = list(self._objects)
+        c = 0
+        for i in range(0, len(pks), chunk_size):
+            with self.__lock:
+                objects = [
+                    o for o in (self._objects.get(pk)
+                                for pk in pks[i:i + chunk_size])
+                    if o is not None
+                ]
+            data = [
+                dumps(o.serialize(mode=mode, allow_deleted=allow_deleted))
+                for o in objects
+                if allow_deleted or o.alive
+            ]
+            stream.write(join(data))
+            c += len(data)
+        logger.debug(
+            f'{self._object_class.__name__} {c} objects exported as {format}')
+        return c
+
+    def import_(self,
+                stream,
+                format='ndjson',
+                override=False,
+                opts={},
+                chunk_size=1000):
+        """
+        Import objects from stream
+
+        Objects are read and inserted into the factory in chunks. The data
+        should contain raw prop values (objects exported without custom
+        serialize_{prop} methods), external props are ignored. Objects are
+        neither saved nor synced
+
+        Args:
+            stream: text (ndjson) or binary (msgpack) stream
+            format: ndjson (newline-delimited JSON) or msgpack
+            override: allow overriding existing objects
+            opts: passed to object constructor as kwargs
+            chunk_size: number of objects inserted at once
+
+        Returns:
+            number of objects imported
+        """
+        if format == 'ndjson':
+            import json
+            records = (json.loads(line) for line in stream if line.strip())
+        elif format == 'msgpack':
+            import importlib
+            records = importlib.import_module('msgpack').Unpacker(stream,
+                                                                  raw=False)
+        else:
+            raise ValueError(f'unsupported format: {format}')
+        c = 0
+        records = iter(records)
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                break
+            objects = []
+            for d in chunk:
+                o = self._object_class(**opts)
+                o.set_prop(
+                    {
+                        k: v
+                        for k, v in d.items()
+                        if not o._property_map.get(k, {}).get('external')
+                    },
+                    _allow_readonly=True,
+                    sync=False,
+                    save=False)
+                objects.append(o)
+            self._append_many(objects, override=override)
+            c += len(objects)
+        logger.debug(f'{self._object_class.__name__} {c} objects imported '
+                     f'from {format}')
+        return c
+
+    def to_columns(self, props=None, mode=None, path=None):
+        """
+        Get serialized data of factory objects as NumPy arrays
+
+        Columns are built in a single pass, without serializing objects into
+        dicts. Array dtypes are derived from prop types: int, float and bool
+        props become numeric / boolean arrays, str props become unicode
+        arrays, other props become object arrays. If a numeric or str column
+        contains None values, it is returned as masked array.
+
+        Requires NumPy module
+
+        Args:
+            props: list of props (default: props of serialization mode)
+            mode: serialization mode
+            path: if specified, arrays are written to {path}/{prop}.npy files
+                (masks of masked arrays to {path}/{prop}.mask.npy), numeric
+                and unicode arrays can be memory-mapped with
+                numpy.load(fname, mmap_mode='r')
+
+        Returns:
+            dict { prop: array }
+        """
+        import importlib
+        np = importlib.import_module('numpy')
+        objects = list(self.get().values())
+        if props is None:
+            props = objects[0]._get_serialize_props(mode) if objects else []
+        n = len(objects)
+        columns = {prop: [None] * n for prop in props}
+        for i, obj in enumerate(objects):
+            for prop, col in columns.items():
+                col[i] = obj.serialize_prop(prop)
+        pmap = objects[0]._property_map if objects else {}
+        result = {}
+        for prop, values in columns.items():
+            tp = (pmap.get(prop) or {}).get('type')
+            dtype = {int: np.int64, float: np.float64, bool: np.bool_,
+                     str: np.str_}.get(tp)
+            arr = None
+            if dtype is not None:
+                mask = np.fromiter((v is None for v in values),
+                                   dtype=bool,
+                                   count=n)
+                has_none = mask.any()
+                if has_none:
+                    fill = dtype()
+                    values = [fill if v is None else v for v in values]
+                try:
+                    arr = np.array(values, dtype=dtype)
+                except (TypeError, ValueError):
+                    # custom serializers may return values of other types
+                    values = columns[prop]
+                else:
+                    if has_none:
+                        arr = np.ma.masked_array(arr, mask=mask)
+            if arr is None:
+                arr = np.empty(n, dtype=object)
+                arr[:] = values
+            result[prop] = arr
+        if path is not None:
+            import os
+            os.makedirs(path, exist_ok=True)
+            for prop, arr in result.items():
+                if isinstance(arr, np.ma.MaskedArray):
+                    np.save(f'{path}/{prop}.mask.npy', np.ma.getmaskarray(arr))
+                    arr = arr.data
+                np.save(f'{path}/{prop}.npy', arr)
+        return result
 
     def save(self, pk=None, force=False):
         """
@@ -267,8 +1534,7 @@ class SmartObjectFactory:
                 for all objects in factory
         """
         if pk:
-            with self.__lock:
-                self.get(pk).save(force)
+            self.get(pk).save(force)
         else:
             for i, o in self.get().items():
                 o.save(force=force)
@@ -282,12 +1548,79 @@ class SmartObjectFactory:
                 for all objects in factory
         """
         if pk:
-            with self.__lock:
-                self.get(pk).sync(force)
+            self.get(pk).sync(force)
         else:
             for i, o in self.get().items():
                 o.sync(force=force)
 
+    def save_many(self, pks=None, force=False):
+        """
+        Save multiple objects in batches
+
+        Objects are saved with a single save_many() call per storage, if
+        storages implement it
+
+        Args:
+            pks: list of object primary keys (default: all objects in factory)
+            force: save objects even if they are not modified
+        """
+        if pks is None:
+            objects = self.get().values()
+        else:
+            objects = self.get_many(pks, missing='raise').values()
+        self._save_objects(objects, force=force)
+
+    def sync_many(self, pks=None, force=False):
+        """
+        Sync multiple objects in batches
+
+        Objects are synced with a single sync_many() call per synchronizer, if
+        synchronizers implement it
+
+        Args:
+            pks: list of object primary keys (default: all objects in factory)
+            force: sync objects even if they are not modified
+        """
+        if pks is None:
+            objects = self.get().values()
+        else:
+            objects = self.get_many(pks, missing='raise').values()
+        self._sync_objects(objects, force=force)
+
+    async def async_save_many(self, pks=None, force=False, limit=None):
+        """
+        Save multiple objects concurrently, asyncio version
+
+        Args:
+            pks: list of object primary keys (default: all objects in factory)
+            force: save objects even if they are not modified
+            limit: max number of concurrent saves (default:
+                aio.concurrency_limit)
+        """
+        if pks is None:
+            objects = self.get().values()
+        else:
+            objects = (await self.async_get_many(pks, limit=limit)).values()
+        await aio.gather((o.async_save(force=force) for o in objects),
+                         limit=limit)
+
+    async def async_sync_many(self, pks=None, force=False, limit=None):
+        """
+        Sync multiple objects concurrently, asyncio version
+
+        Args:
+            pks: list of object primary keys (default: all objects in factory)
+            force: sync objects even if they are not modified
+            limit: max number of concurrent syncs (default:
+                aio.concurrency_limit)
+        """
+        if pks is None:
+            objects = self.get().values()
+        else:
+            objects = (await self.async_get_many(pks, limit=limit)).values()
+        await aio.gather((o.async_sync(force=force) for o in objects),
+                         limit=limit)
+
     def set_prop(self, pk, *args, **kwargs):
         """
         Call set_prop method of the specified object
@@ -302,6 +1635,120 @@ class SmartObjectFactory:
             obj.save()
         return result
 
+    def set_prop_many(self, pks, prop, values, save=None, sync=True):
+        """
+        Set property of multiple objects
+
+        All values are validated before any object is changed. Modified
+        objects are synced and saved in batches, with a single sync_many() /
+        save_many() call per synchronizer / storage, if they implement these
+        methods
+
+        Args:
+            pks: list of object primary keys
+            prop: object property
+            values: list of values or a single value for all objects
+            save: save modified objects (default: if factory autosave is on)
+            sync: sync modified objects (default: True)
+
+        Returns:
+            number of objects modified
+
+        Raises:
+            KeyError: if some objects are not found
+            AttributeError: if no such property, property is read-only or
+                external
+            ValueError: if any value is invalid
+        """
+        objects = self.get_many(pks, missing='raise')
+        objects = [objects[pk] for pk in pks]
+        if isinstance(values, (list, tuple)):
+            if len(values) != len(objects):
+                raise ValueError('number of values and objects differ')
+        else:
+            values = [values] * len(objects)
+        if not objects:
+            return 0
+        p = objects[0]._property_map.get(prop)
+        if p is None:
+            raise AttributeError(f'no such property: "{prop}"')
+        if p.get('read-only') or p.get('external'):
+            raise AttributeError(f'property "{prop}" can not be set in bulk')
+        formatted = []
+        for obj, value in zip(objects, values):
+            if value is None and 'default' in p:
+                value = p['default']
+            formatted.append(
+                obj.prepare_value(prop, obj._format_value(prop, value)))
+        changed = []
+        for obj, value in zip(objects, formatted):
+            result, old_value = obj._set_prop_value(prop, value)
+            if result:
+                changed.append(obj)
+                # indexes and sizes are updated without holding object locks
+                self._on_prop_changed(obj, prop, old_value)
+        if changed:
+            logger.log(
+                p.get('log-level', 20),
+                f'Setting {self._object_class.__name__} {prop} for '
+                f'{len(changed)} objects')
+            if sync:
+                self._sync_objects(changed)
+            if save or (save is None and self.autosave):
+                self._save_objects(changed)
+        return len(changed)
+
+    def _save_objects(self, objects, force=False):
+        # save objects with a single call per storage
+        from . import storage
+        batches = {}
+        for obj in objects:
+            if obj.alive:
+                for storage_id, d in obj._get_save_data(force).items():
+                    batches.setdefault(storage_id, []).append((obj,) + d)
+        for storage_id, batch in batches.items():
+            s = storage.get_storage(storage_id)
+            items = [(obj._get_primary_key(), data, modified)
+                     for obj, data, modified in batch]
+            if hasattr(s, 'save_many'):
+                aio._blocking_result(s.save_many(items))
+            else:
+                for pk, data, modified in items:
+                    aio._blocking_result(
+                        s.save(pk=pk, data=data, modified=modified))
+            for obj, _, modified in batch:
+                obj._clear_modified(storage_id, modified)
+
+    def _sync_objects(self, objects, force=False):
+        # sync objects with a single call per synchronizer
+        from . import sync
+        batches = {}
+        for obj in objects:
+            if obj.alive:
+                pk = obj._get_primary_key(_allow_null=False)
+                for sync_id, data in obj._pop_sync_data(force).items():
+                    batches.setdefault(sync_id, []).append((obj, pk, data))
+        sent = dict.fromkeys(batches, 0)
+        try:
+            for sync_id, batch in batches.items():
+                s = sync.get_sync(sync_id)
+                if hasattr(s, 'sync_many'):
+                    aio._blocking_result(
+                        s.sync_many([(pk, data) for _, pk, data in batch]))
+                    for obj, _, data in batch:
+                        obj._commit_sync_data(sync_id, data)
+                    sent[sync_id] = len(batch)
+                else:
+                    for obj, pk, data in batch:
+                        aio._blocking_result(s.sync(pk, data))
+                        obj._commit_sync_data(sync_id, data)
+                        sent[sync_id] += 1
+        finally:
+            # data of failed and not sent syncs is marked modified again
+            for sync_id, batch in batches.items():
+                for obj, _, data in batch[sent[sync_id]:]:
+                    obj._restore_sync_data(sync_id, data)
+
     def serialize(self, pk, *args, **kwargs):
         """
         Serialize object
@@ -316,11 +1763,17 @@ class SmartObjectFactory:
         Args:
             obj: object or object primary key, required
         """
-        with self.__lock:
-            if not isinstance(obj, self._object_class):
-                obj = self.get(obj)
-            self.remove(obj=obj)
-            obj.delete(_call_factory=False)
+        if not isinstance(obj, self._object_class):
+            obj = self.get(obj)
+        self.remove(obj=obj)
+        if self.versioning:
+            with self.__lock:
+                self.version += 1
+                pk = obj._get_primary_key()
+                self._changes.pop(pk, None)
+                self._changes[pk] = [self.version, None]
+                self._trim_changes()
+        obj.delete(_call_factory=False)
 
     def clear(self):
         """
@@ -328,7 +1781,21 @@ class SmartObjectFactory:
         """
         logger.debug(f'Clearing factory objects {self._object_class.__name__}')
         with self.__lock:
+            for obj in self._objects.values():
+                obj._object_factory = None
             self._objects.clear()
+            with self.__index_lock:
+                self._index_values.clear()
+                for index in self._objects_by_prop.values():
+                    index.clear()
+                for keys in self._sorted_keys.values():
+                    keys.clear()
+            self._objects_created.clear()
+            self._objects_accessed.clear()
+            self._negative.clear()
+            self._sizes.clear()
+            self.total_bytes = 0
+            self._changes.clear()
 
     def cleanup_storage(self, storage_id=None, opts={}):
         """
@@ -341,51 +1808,270 @@ class SmartObjectFactory:
             storage_id: storage id to cleanup or None for default storage
             opts: passed to storage.cleanup() as kwargs
         """
-        if self.maxsize is not None:
+        if self.maxsize is not None or self.max_bytes is not None:
             raise RuntimeError('Can not perform cleanup, size limits are set')
         from . import storage
         logger.debug(
             f'{self._object_class.__name__} storage {storage_id} cleanup')
         with self.__lock:
-            return storage.get_storage(storage_id).cleanup(
-                list(self.get()), **opts)
+            pks = list(self._objects)
+        return storage.get_storage(storage_id).cleanup(pks, **opts)
+
+    def stats(self):
+        """
+        Get factory stats snapshot
+
+        Returns:
+            dict with number of objects, total bytes (if sizer is set), index
+            sizes (number of distinct keys) and factory metrics, if enabled
+        """
+        with self.__lock:
+            result = {'objects': len(self._objects)}
+            if self.sizer is not None:
+                result['total_bytes'] = self.total_bytes
+        with self.__index_lock:
+            result['indexes'] = {
+                ','.join(p) if isinstance(p, tuple) else p: len(index)
+                for p, index in self._objects_by_prop.items()
+            }
+        if self.metrics is not None:
+            result.update(self.metrics.stats())
+        return result
+
+    def largest_objects(self, limit=10):
+        """
+        Get the largest objects in the factory
+
+        Requires factory sizer to be set
+
+        Args:
+            limit: max number of objects returned
+
+        Returns:
+            list of tuples (pk, size), the largest first
+        """
+        with self.__lock:
+            return nlargest(limit, self._sizes.items(), key=itemgetter(1))
 
     def purge(self):
         """
         Purge factory object cache
+
+        If writeback is enabled, modified objects are saved before being
+        dropped. Objects, which can not be saved, are kept in the factory
+        """
+        objects = self._get_purge_candidates()
+        if objects:
+            c = len(self._evict(objects))
+            logger.debug(f'{self._object_class.__name__} {c} objects purged')
+
+    async def async_purge(self):
+        """
+        Purge factory object cache, asyncio version
+
+        Modified objects are saved with SmartObject.async_save()
+        """
+        objects = self._get_purge_candidates()
+        if objects:
+            c = len(await self._async_evict(objects))
+            logger.debug(f'{self._object_class.__name__} {c} objects purged')
+
+    def _get_purge_candidates(self):
+        if self.maxsize is None and self.max_bytes is None:
+            return []
+        with self.__lock:
+            excess = len(self._objects) - self.maxsize \
+                    if self.maxsize is not None else 0
+            excess_bytes = self.total_bytes - self.max_bytes \
+                    if self.max_bytes is not None else 0
+            objects = []
+            for pk, obj in self._objects.items():
+                if excess <= 0 and excess_bytes <= 0:
+                    break
+                objects.append(obj)
+                excess -= 1
+                excess_bytes -= self._sizes.get(pk, 0)
+            return objects
+
+    def _evict(self, objects, reason='size'):
+        # modified objects are saved without holding the factory lock
+        failed = set()
+        if self.writeback:
+            for obj in objects:
+                if obj._is_modified():
+                    t_start = time.perf_counter()
+                    try:
+                        obj.save()
+                    except Exception as e:
+                        self._evict_save_failed(obj, e)
+                        failed.add(obj)
+                    self._evict_saved(obj, obj not in failed, t_start)
+        return self._remove_evicted(objects, failed, reason)
+
+    async def _async_evict(self, objects, reason='size'):
+        failed = set()
+        if self.writeback:
+
+            async def save(obj):
+                t_start = time.perf_counter()
+                try:
+                    await obj.async_save()
+                except Exception as e:
+                    self._evict_save_failed(obj, e)
+                    failed.add(obj)
+                self._evict_saved(obj, obj not in failed, t_start)
+
+            await aio.gather(save(obj) for obj in objects if obj._is_modified())
+        return self._remove_evicted(objects, failed, reason)
+
+    def _evict_save_failed(self, obj, e):
+        logger.error(f'Unable to save {self._object_class.__name__} '
+                     f'{obj._get_primary_key()} before eviction: {e}')
+
+    def _evict_saved(self, obj, success, t_start):
+        with self.__lock:
+            self.flush_time += time.perf_counter() - t_start
+            if success:
+                self.dirty_evictions += 1
+
+    def _remove_evicted(self, objects, failed, reason):
+        evicted = []
+        with self.__lock:
+            for obj in objects:
+                pk = obj._get_primary_key()
+                if self._objects.get(pk) is not obj:
+                    # already removed or replaced
+                    continue
+                if obj in failed:
+                    # keep the object and let others be evicted next time
+                    self._objects.move_to_end(pk)
+                    self._renew(pk)
+                elif not self.writeback or not obj._is_modified():
+                    self.remove(obj, _evicted=True)
+                    evicted.append(obj)
+        if self.metrics is not None and evicted:
+            self.metrics.inc(f'evictions_{reason}', len(evicted))
+        if self.on_evict is not None:
+            for obj in evicted:
+                self.on_evict(obj, reason)
+        return evicted
+
+    def _renew(self, pk):
+        now = time.monotonic()
+        for times in (self._objects_created, self._objects_accessed):
+            if pk in times:
+                times[pk] = now
+                times.move_to_end(pk)
+
+    def _get_expired(self, pk, now):
+        if self.ttl is not None and self._objects_created.get(
+                pk, now) + self.ttl <= now:
+            return 'ttl'
+        if self.idle_ttl is not None and self._objects_accessed.get(
+                pk, now) + self.idle_ttl <= now:
+            return 'idle'
+
+    def reap(self, batch_size=1000):
+        """
+        Remove expired objects from the factory
+
+        Objects are evicted in batches, the factory lock is not held while
+        modified objects are saved
+
+        Args:
+            batch_size: max number of objects evicted per batch
+
+        Returns:
+            number of evicted objects
+        """
+        c = 0
+        while True:
+            more = False
+            for reason, ttl, times in (('ttl', self.ttl,
+                                        self._objects_created),
+                                       ('idle', self.idle_ttl,
+                                        self._objects_accessed)):
+                if ttl is None:
+                    continue
+                batch = []
+                with self.__lock:
+                    now = time.monotonic()
+                    for pk, t in times.items():
+                        if t + ttl > now or len(batch) >= batch_size:
+                            break
+                        batch.append(self._objects[pk])
+                if batch:
+                    n = len(self._evict(batch, reason))
+                    c += n
+                    more = more or (n > 0 and len(batch) >= batch_size)
+            if not more:
+                break
+        if c:
+            logger.debug(f'{self._object_class.__name__} {c} objects expired')
+        return c
+
+    def start_reaper(self, interval=1):
+        """
+        Start background thread, which removes expired objects
+
+        Args:
+            interval: reaper run interval (seconds)
+
+        Raises:
+            RuntimeError: if reaper is already started
+        """
+        with self.__lock:
+            if self._reaper is not None:
+                raise RuntimeError('Reaper is already started')
+            self._reaper_event = threading.Event()
+            self._reaper = threading.Thread(
+                target=self._run_reaper,
+                args=(interval, self._reaper_event),
+                name=f'smartobject_reaper_{self._object_class.__name__}',
+                daemon=True)
+            self._reaper.start()
+
+    def stop_reaper(self):
+        """
+        Stop background reaper thread
         """
-        if self.maxsize is None: return
         with self.__lock:
-            if len(self._objects) > self.maxsize:
-                c = 0
-                for x in sorted(self._objects_last_access.items(),
-                                key=lambda kv: kv[1])[:len(self._objects) -
-                                                      self.maxsize]:
-                    self.remove(x[0])
-                    c += 1
-                logger.debug(
-                    f'{self._object_class.__name__} {c} objects purged')
-
-    def remove(self, obj):
+            reaper = self._reaper
+            if reaper is None:
+                return
+            self._reaper_event.set()
+            self._reaper = None
+        reaper.join()
+
+    def _run_reaper(self, interval, event):
+        while not event.wait(interval):
+            try:
+                self.reap()
+            except Exception as e:
+                logger.error(
+                    f'{self._object_class.__name__} reaper error: {e}')
+
+    def remove(self, obj, _evicted=False):
         """
         Remove object from the factory
 
         Args:
             obj: object or object primary key, required
         """
+        if not isinstance(obj, self._object_class):
+            obj = self.get(obj)
         with self.__lock:
-            if not isinstance(obj, self._object_class):
-                obj = self.get(obj)
             pk = obj._get_primary_key()
             logger.debug('Removing object ' +
                          f'{self._object_class.__name__} {pk} from factory')
             obj._object_factory = None
-            for p in self._objects_by_prop:
-                val = getattr(obj, p)
-                if val is not None:
-                    try:
-                        self._objects_by_prop[p][val].remove(obj)
-                    except (ValueError, KeyError):
-                        pass
+            self._unindex(obj)
             del self._objects[pk]
-            del self._objects_last_access[pk]
+            self._objects_created.pop(pk, None)
+            self._objects_accessed.pop(pk, None)
+            self.total_bytes -= self._sizes.pop(pk, 0)
+            # change records of removed and evicted objects are kept, so
+            # incremental readers do not miss their last changes
+        # evictions are counted separately
+        if self.metrics is not None and not _evicted:
+            self.metrics.inc('removes')
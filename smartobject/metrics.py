@@ -0,0 +1,455 @@
+import threading
+import inspect
+import sys
+
+from bisect import bisect_left
+from functools import partial
+from random import random
+from time import perf_counter
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+"""
+Default histogram bucket upper bounds (seconds)
+"""
+
+STORAGE_OPS = ('load', 'load_many', 'load_by_prop', 'count', 'save',
+               'save_many', 'delete', 'get_prop', 'set_prop', 'purge',
+               'cleanup')
+"""
+Instrumented storage methods
+"""
+
+SYNC_OPS = ('sync', 'sync_many', 'delete')
+"""
+Instrumented synchronizer methods
+"""
+
+# payload args (position, name) of instrumented methods, for other methods the
+# payload is the method result
+_PAYLOAD_ARGS = {
+    'save': (1, 'data'),
+    'save_many': (0, 'items'),
+    'sync': (1, 'data'),
+    'sync_many': (0, 'items'),
+    'set_prop': (2, 'value')
+}
+_PAYLOAD_RESULTS = ('load', 'load_many', 'load_by_prop', 'get_prop')
+
+backend_metrics = None
+"""
+Storage and sync metrics, if instrumentation is enabled
+"""
+
+
+def value_size(value):
+    """
+    Get approximate value size in bytes
+
+    Includes sizes of items of lists, tuples, sets and dicts
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += value_size(k) + value_size(v)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for v in value:
+            size += value_size(v)
+    return size
+
+
+class Histogram:
+    """
+    Histogram of observed values
+
+    Bucket counts are not cumulative, the last bucket counts values, which are
+    greater than all bounds
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def serialize(self):
+        return {
+            'buckets': list(self.buckets),
+            'counts': self.counts.copy(),
+            'count': self.count,
+            'sum': self.sum
+        }
+
+
+class FactoryMetrics:
+    """
+    Smart Object factory metrics
+
+    Collects counters and histograms of a factory, created with metrics=True
+    or metrics=FactoryMetrics(...) argument
+
+    Counters:
+        hits, misses: objects got by primary key, found and not found in
+            factory
+        prop_hits, prop_misses: objects got by indexed prop
+        autoloads, autoload_errors: objects auto-loaded from storage
+        creates, removes: objects inserted into / explicitly removed from
+            factory
+        evictions_size, evictions_ttl, evictions_idle: objects evicted
+
+    Histograms:
+        autoload_time: object auto-load latency (seconds)
+        lock_wait: factory lock wait time (seconds), only contended
+            acquisitions are observed
+    """
+
+    def __init__(self, callback=None, buckets=LATENCY_BUCKETS):
+        """
+        Args:
+            callback: function, called with (name, value) arguments on each
+                counter increment or histogram observation
+            buckets: histogram bucket upper bounds
+        """
+        self.callback = callback
+        self.counters = dict.fromkeys(
+            ('hits', 'misses', 'prop_hits', 'prop_misses', 'autoloads',
+             'autoload_errors', 'creates', 'removes', 'evictions_size',
+             'evictions_ttl', 'evictions_idle'), 0)
+        self.histograms = {
+            'autoload_time': Histogram(buckets),
+            'lock_wait': Histogram(buckets)
+        }
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        """
+        Increment counter
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.callback is not None:
+            self.callback(name, value)
+
+    def observe(self, name, value):
+        """
+        Observe histogram value
+        """
+        with self._lock:
+            self.histograms[name].observe(value)
+        if self.callback is not None:
+            self.callback(name, value)
+
+    def stats(self):
+        """
+        Get metrics snapshot
+
+        Returns:
+            dict with counters and serialized histograms
+        """
+        with self._lock:
+            result = self.counters.copy()
+            for name, h in self.histograms.items():
+                result[name] = h.serialize()
+        return result
+
+    def reset(self):
+        """
+        Reset all counters and histograms
+        """
+        with self._lock:
+            for name in self.counters:
+                self.counters[name] = 0
+            for name, h in self.histograms.items():
+                self.histograms[name] = Histogram(h.buckets)
+
+
+class TimedLock:
+    """
+    Lock wrapper, which reports lock wait time to metrics
+
+    Uncontended acquisitions are not timed
+    """
+
+    def __init__(self, lock, metrics, name='lock_wait'):
+        self._lock = lock
+        self._metrics = metrics
+        self._name = name
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            return True
+        elif not blocking:
+            return False
+        t_start = perf_counter()
+        result = self._lock.acquire(True, timeout)
+        self._metrics.observe(self._name, perf_counter() - t_start)
+        return result
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class BackendMetrics:
+    """
+    Storage and sync metrics
+
+    Collects per-backend, per-operation call counts, errors, latencies and
+    approximate payload sizes. If sample rate is below 1, only the sampled
+    calls are recorded
+    """
+
+    def __init__(self, sample_rate=1, buckets=LATENCY_BUCKETS):
+        """
+        Args:
+            sample_rate: share of calls recorded (0..1, default: 1)
+            buckets: latency histogram bucket upper bounds
+        """
+        self.sample_rate = sample_rate
+        self.buckets = buckets
+        self._ops = {}
+        self._lock = threading.Lock()
+
+    def record(self, kind, backend_id, op, duration, payload=0, error=False):
+        """
+        Record backend call
+
+        Args:
+            kind: "storage" or "sync"
+            backend_id: storage or sync id
+            op: method name
+            duration: call duration (seconds)
+            payload: approximate payload size (bytes)
+            error: True if the call raised an exception
+        """
+        key = (kind, backend_id, op)
+        with self._lock:
+            m = self._ops.get(key)
+            if m is None:
+                m = self._ops[key] = {
+                    'calls': 0,
+                    'errors': 0,
+                    'payload_bytes': 0,
+                    'time': Histogram(self.buckets)
+                }
+            m['calls'] += 1
+            if error:
+                m['errors'] += 1
+            m['payload_bytes'] += payload
+            m['time'].observe(duration)
+
+    def stats(self):
+        """
+        Get metrics snapshot
+
+        Returns:
+            dict { "sample_rate": rate, kind: { backend_id: { op: metrics }}}
+        """
+        result = {'sample_rate': self.sample_rate, 'storage': {}, 'sync': {}}
+        with self._lock:
+            for (kind, backend_id, op), m in self._ops.items():
+                d = m.copy()
+                d['time'] = m['time'].serialize()
+                result[kind].setdefault(backend_id, {})[op] = d
+        return result
+
+    def prometheus(self, prefix='smartobject'):
+        """
+        Get metrics in Prometheus text format
+
+        Default backend id is exported as "default"
+
+        Args:
+            prefix: metric name prefix
+        """
+        calls = []
+        errors = []
+        payload = []
+        times = []
+        with self._lock:
+            for (kind, backend_id, op), m in sorted(
+                    self._ops.items(), key=lambda x: repr(x[0])):
+                backend = 'default' if backend_id is None else backend_id
+                labels = f'kind="{kind}",backend="{backend}",op="{op}"'
+                calls.append(f'{prefix}_backend_calls_total{{{labels}}} '
+                             f'{m["calls"]}')
+                errors.append(f'{prefix}_backend_errors_total{{{labels}}} '
+                              f'{m["errors"]}')
+                payload.append(
+                    f'{prefix}_backend_payload_bytes_total{{{labels}}} '
+                    f'{m["payload_bytes"]}')
+                h = m['time']
+                c = 0
+                for le, n in zip(h.buckets + ('+Inf',), h.counts):
+                    c += n
+                    times.append(f'{prefix}_backend_duration_seconds_bucket'
+                                 f'{{{labels},le="{le}"}} {c}')
+                times.append(f'{prefix}_backend_duration_seconds_sum'
+                             f'{{{labels}}} {h.sum}')
+                times.append(f'{prefix}_backend_duration_seconds_count'
+                             f'{{{labels}}} {h.count}')
+        result = []
+        for name, tp, lines in (('calls_total', 'counter', calls),
+                                ('errors_total', 'counter', errors),
+                                ('payload_bytes_total', 'counter', payload),
+                                ('duration_seconds', 'histogram', times)):
+            result.append(f'# TYPE {prefix}_backend_{name} {tp}')
+            result += lines
+        return '\n'.join(result) + '\n'
+
+    def write_prometheus(self, path, prefix='smartobject'):
+        """
+        Write metrics in Prometheus text format to file
+
+        The file is replaced atomically, e.g. for node exporter textfile
+        collector
+
+        Args:
+            path: file path
+            prefix: metric name prefix
+        """
+        import os
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as fh:
+            fh.write(self.prometheus(prefix))
+        os.replace(tmp, path)
+
+    def reset(self):
+        """
+        Reset all metrics
+        """
+        with self._lock:
+            self._ops.clear()
+
+
+class InstrumentedBackend:
+    """
+    Storage or sync wrapper, which records calls of backend methods
+
+    Other attributes are proxied to the backend as-is
+    """
+
+    def __init__(self, backend, kind, backend_id, metrics):
+        for k, v in (('_backend', backend), ('_kind', kind),
+                     ('_backend_id', backend_id), ('_metrics', metrics),
+                     ('_ops', STORAGE_OPS if kind == 'storage' else SYNC_OPS)):
+            object.__setattr__(self, k, v)
+
+    def __getattr__(self, name):
+        attr = getattr(self._backend, name)
+        if name in self._ops and callable(attr):
+            # keep async methods coroutine functions, to be awaited by callers
+            if inspect.iscoroutinefunction(attr):
+                return partial(self._async_call, name, attr)
+            return partial(self._call, name, attr)
+        return attr
+
+    def __setattr__(self, name, value):
+        setattr(self._backend, name, value)
+
+    def _call(self, op, method, *args, **kwargs):
+        metrics = self._metrics
+        if metrics.sample_rate < 1 and random() >= metrics.sample_rate:
+            return method(*args, **kwargs)
+        t_start = perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except:
+            metrics.record(self._kind,
+                           self._backend_id,
+                           op,
+                           perf_counter() - t_start,
+                           error=True)
+            raise
+        metrics.record(self._kind, self._backend_id, op,
+                       perf_counter() - t_start,
+                       self._payload(op, args, kwargs, result))
+        return result
+
+    async def _async_call(self, op, method, *args, **kwargs):
+        metrics = self._metrics
+        if metrics.sample_rate < 1 and random() >= metrics.sample_rate:
+            return await method(*args, **kwargs)
+        t_start = perf_counter()
+        try:
+            result = await method(*args, **kwargs)
+        except:
+            metrics.record(self._kind,
+                           self._backend_id,
+                           op,
+                           perf_counter() - t_start,
+                           error=True)
+            raise
+        metrics.record(self._kind, self._backend_id, op,
+                       perf_counter() - t_start,
+                       self._payload(op, args, kwargs, result))
+        return result
+
+    @staticmethod
+    def _payload(op, args, kwargs, result):
+        if op in _PAYLOAD_ARGS:
+            pos, name = _PAYLOAD_ARGS[op]
+            return value_size(
+                args[pos] if len(args) > pos else kwargs.get(name))
+        elif op in _PAYLOAD_RESULTS:
+            return value_size(result)
+        else:
+            return 0
+
+def wrap_backend(kind, backend_id, backend):
+    """
+    Wrap storage or sync with InstrumentedBackend, if instrumentation is
+    enabled
+    """
+    if backend_metrics is None or isinstance(backend, InstrumentedBackend):
+        return backend
+    return InstrumentedBackend(backend, kind, backend_id, backend_metrics)
+
+
+def instrument(sample_rate=1, buckets=LATENCY_BUCKETS):
+    """
+    Enable storage and sync instrumentation
+
+    Storages and synchronizers, which are already defined or defined later
+    with define_storage() / define_sync(), are wrapped with
+    InstrumentedBackend
+
+    Args:
+        sample_rate: share of calls recorded (0..1, default: 1)
+        buckets: latency histogram bucket upper bounds
+
+    Returns:
+        BackendMetrics object
+    """
+    global backend_metrics
+    uninstrument()
+    backend_metrics = BackendMetrics(sample_rate=sample_rate, buckets=buckets)
+    from . import storage, sync
+    for kind, backends in (('storage', storage.storages), ('sync',
+                                                           sync.syncs)):
+        for k, v in backends.items():
+            backends[k] = wrap_backend(kind, k, v)
+    return backend_metrics
+
+
+def uninstrument():
+    """
+    Disable storage and sync instrumentation
+    """
+    global backend_metrics
+    backend_metrics = None
+    from . import storage, sync
+    for backends in (storage.storages, sync.syncs):
+        for k, v in backends.items():
+            if isinstance(v, InstrumentedBackend):
+                backends[k] = v._backend
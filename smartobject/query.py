@@ -0,0 +1,81 @@
+RANGE_OPS = ('gt', 'ge', 'lt', 'le', 'prefix')
+"""
+Operators, which can be resolved with sorted indexes
+"""
+
+OPS = ('eq', 'ne', 'in', 'nin') + RANGE_OPS
+"""
+All supported query operators
+"""
+
+# an index is intersected with the current candidates only if it isn't much
+# larger, otherwise filtering the candidates is cheaper than building the set
+INTERSECT_RATIO = 8
+
+
+class Predicate:
+    """
+    Query predicate: object prop, operator and value
+    """
+
+    def __init__(self, prop, op, value):
+        if op not in OPS:
+            raise ValueError(f'invalid query operator: {op}')
+        if op in ('in', 'nin'):
+            value = set(value)
+        self.prop = prop
+        self.op = op
+        self.value = value
+
+    def match(self, obj):
+        """
+        Check if object matches the predicate
+        """
+        v = getattr(obj, self.prop)
+        op = self.op
+        if op == 'eq':
+            return v == self.value
+        elif op == 'ne':
+            return v != self.value
+        elif op == 'in':
+            return v in self.value
+        elif op == 'nin':
+            return v not in self.value
+        elif v is None:
+            return False
+        elif op == 'gt':
+            return v > self.value
+        elif op == 'ge':
+            return v >= self.value
+        elif op == 'lt':
+            return v < self.value
+        elif op == 'le':
+            return v <= self.value
+        else:
+            return v.startswith(self.value)
+
+    def __str__(self):
+        return f'{self.prop} {self.op} {self.value!r}'
+
+
+def parse(where):
+    """
+    Parse query conditions
+
+    Args:
+        where: dict { prop: value } or { prop: { op: value } }, where op is one
+            of: eq, ne, in, nin (not in), gt, ge, lt, le, prefix
+
+    Returns:
+        list of predicates
+    """
+    result = []
+    for prop, cond in where.items():
+        if isinstance(cond, dict):
+            if not cond:
+                raise ValueError(f'no query operators for "{prop}"')
+            for op, value in cond.items():
+                result.append(Predicate(prop, op, value))
+        else:
+            result.append(Predicate(prop, 'eq', cond))
+    return result
@@ -0,0 +1,259 @@
+import pickle
+import struct
+import threading
+import inspect
+import time
+
+from multiprocessing import shared_memory, resource_tracker
+
+# header: magic, sequence, number of objects, data size, index offset, index
+# size
+_HEADER = struct.Struct('<8sQQQQQ')
+_MAGIC = b'SOSHM001'
+_SEQ = struct.Struct('<Q')
+_SEQ_OFFSET = 8
+
+# Python 3.13+ can attach shared memory without resource tracking
+_TRACK_ARG = 'track' in inspect.signature(
+    shared_memory.SharedMemory).parameters
+
+
+def _attach(name):
+    # attach to existing shared memory without taking ownership, otherwise
+    # resource tracker of a non-forked process unlinks it on exit
+    if _TRACK_ARG:
+        return shared_memory.SharedMemory(name, track=False)
+    shm = shared_memory.SharedMemory(name)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class SharedFactory:
+    """
+    Publishes objects of a factory into a shared memory region
+
+    The owner process keeps the factory and calls publish() after objects are
+    changed, worker processes read objects with SharedFactoryReader. Objects
+    are published serialized, with a primary key index
+    """
+
+    def __init__(self, factory, name=None, size=64 * 1024 * 1024, mode=None):
+        """
+        Args:
+            factory: SmartObjectFactory object
+            name: shared memory name (default: generated)
+            size: shared memory region size, bytes
+            mode: object serialization mode
+        """
+        self.factory = factory
+        self.mode = mode
+        self.shm = shared_memory.SharedMemory(name=name,
+                                              create=True,
+                                              size=size)
+        self.name = self.shm.name
+        self.version = 0
+        self._factory_version = None
+        self._lock = threading.Lock()
+        _HEADER.pack_into(self.shm.buf, 0, _MAGIC, 0, 0, 0, 0, 0)
+
+    def publish(self, force=False):
+        """
+        Publish factory objects into shared memory
+
+        If factory versioning is on, objects are published only if changed
+        since the last call
+
+        Args:
+            force: publish objects even if not changed
+
+        Returns:
+            published version
+
+        Raises:
+            RuntimeError: if objects do not fit the shared memory region
+        """
+        with self._lock:
+            factory_version = self.factory.version if getattr(
+                self.factory, 'versioning', False) else None
+            if (not force and factory_version is not None and
+                    factory_version == self._factory_version):
+                return self.version
+            chunks = []
+            index = {}
+            offset = _HEADER.size
+            for pk, obj in self.factory.get().items():
+                data = pickle.dumps(obj.serialize(mode=self.mode),
+                                    protocol=5)
+                index[pk] = (offset, len(data))
+                chunks.append(data)
+                offset += len(data)
+            index_data = pickle.dumps(index, protocol=5)
+            if offset + len(index_data) > self.shm.size:
+                raise RuntimeError(
+                    f'Shared memory region is too small ({self.shm.size} '
+                    f'bytes), {offset + len(index_data)} bytes required')
+            buf = self.shm.buf
+            seq = _SEQ.unpack_from(buf, _SEQ_OFFSET)[0]
+            # odd sequence: the region is being written
+            _SEQ.pack_into(buf, _SEQ_OFFSET, seq + 1)
+            pos = _HEADER.size
+            for data in chunks:
+                buf[pos:pos + len(data)] = data
+                pos += len(data)
+            buf[pos:pos + len(index_data)] = index_data
+            _HEADER.pack_into(buf, 0, _MAGIC, seq + 1, len(index),
+                              pos - _HEADER.size, pos, len(index_data))
+            _SEQ.pack_into(buf, _SEQ_OFFSET, seq + 2)
+            self.version = (seq + 2) // 2
+            self._factory_version = factory_version
+            return self.version
+
+    def close(self, unlink=True):
+        """
+        Close shared memory
+
+        Args:
+            unlink: destroy shared memory region (default: True)
+        """
+        self.shm.close()
+        if unlink:
+            if not _TRACK_ARG:
+                # forked readers could unregister the region
+                resource_tracker.register(self.shm._name, 'shared_memory')
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SharedFactoryReader:
+    """
+    Read-only access to objects, published by SharedFactory
+
+    Objects are deserialized directly from shared memory buffers. The reader
+    picks up new versions automatically, reads, overlapped with publishing,
+    are retried
+    """
+
+    def __init__(self, name, timeout=5):
+        """
+        Args:
+            name: shared memory name (SharedFactory.name)
+            timeout: max time to wait for the publisher to finish writing
+        """
+        self.shm = _attach(name)
+        if bytes(self.shm.buf[:len(_MAGIC)]) != _MAGIC:
+            self.shm.close()
+            raise ValueError(f'{name} is not a shared factory region')
+        self.timeout = timeout
+        self._seq = None
+        self._index = {}
+
+    def _read(self, fn):
+        # seqlock read: retry if the region was written during the read
+        buf = self.shm.buf
+        t_end = time.monotonic() + self.timeout
+        while True:
+            seq = _SEQ.unpack_from(buf, _SEQ_OFFSET)[0]
+            if not seq & 1:
+                try:
+                    if seq != self._seq:
+                        _, _, _, _, index_offset, index_size = \
+                            _HEADER.unpack_from(buf, 0)
+                        index = pickle.loads(
+                            buf[index_offset:index_offset +
+                                index_size]) if index_size else {}
+                    else:
+                        index = self._index
+                    result = fn(buf, index)
+                except Exception:
+                    # errors of reads, overlapped with writing, are ignored
+                    if _SEQ.unpack_from(buf, _SEQ_OFFSET)[0] == seq:
+                        raise
+                else:
+                    if _SEQ.unpack_from(buf, _SEQ_OFFSET)[0] == seq:
+                        self._seq = seq
+                        self._index = index
+                        return result
+            if time.monotonic() > t_end:
+                raise TimeoutError('Shared factory is locked for writing')
+            time.sleep(0)
+
+    @property
+    def version(self):
+        """
+        Current published version
+        """
+        return _SEQ.unpack_from(self.shm.buf, _SEQ_OFFSET)[0] // 2
+
+    def get(self, pk):
+        """
+        Get serialized object data
+
+        Args:
+            pk: object primary key
+
+        Raises:
+            KeyError: if object is not published
+
+        Returns:
+            dict with object data
+        """
+
+        def fn(buf, index):
+            offset, size = index[pk]
+            return pickle.loads(buf[offset:offset + size])
+
+        return self._read(fn)
+
+    def get_many(self, pks):
+        """
+        Get serialized data of multiple objects, objects not published are
+        skipped
+
+        Args:
+            pks: list of object primary keys
+
+        Returns:
+            dict { pk: data }
+        """
+
+        def fn(buf, index):
+            result = {}
+            for pk in pks:
+                try:
+                    offset, size = index[pk]
+                except KeyError:
+                    continue
+                result[pk] = pickle.loads(buf[offset:offset + size])
+            return result
+
+        return self._read(fn)
+
+    def keys(self):
+        """
+        Get primary keys of published objects
+        """
+        return self._read(lambda buf, index: list(index))
+
+    def __contains__(self, pk):
+        return self._read(lambda buf, index: pk in index)
+
+    def __len__(self):
+        return self._read(lambda buf, index: len(index))
+
+    def close(self):
+        """
+        Detach from shared memory
+        """
+        self._index = {}
+        self.shm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -2,6 +2,7 @@ from . import config
 from . import storage
 from . import sync
 from . import constants
+from . import aio
 
 import logging
 import threading
@@ -27,8 +28,10 @@ class SmartObject(object):
                 if name in self.__externals:
                     return self._format_value(
                         name,
-                        storage.get_storage(self.__externals[name]).get_prop(
-                            self._get_primary_key(), name))
+                        aio._blocking_result(
+                            storage.get_storage(
+                                self.__externals[name]).get_prop(
+                                    self._get_primary_key(), name)))
             except AttributeError:
                 pass
         return super().__getattribute__(name)
@@ -37,8 +40,9 @@ class SmartObject(object):
         if not name.startswith('_') and config.auto_externals:
             try:
                 if name in self.__externals:
-                    return storage.get_storage(self.__externals[name]).set_prop(
-                        self._get_primary_key(), name, value)
+                    return aio._blocking_result(
+                        storage.get_storage(self.__externals[name]).set_prop(
+                            self._get_primary_key(), name, value))
             except AttributeError:
                 pass
         return super().__setattr__(name, value)
@@ -92,6 +96,8 @@ class SmartObject(object):
         self.__sync_always = {None: set()}
         self.__syncs = set()
         self.__sync_map = {}
+        # the last synced values { sync_id: { prop: value } }
+        self.__synced = {}
         self.__externals = {}
         self._object_factory = None
         self.__snapshot = None
@@ -162,6 +168,41 @@ class SmartObject(object):
     def _set_primary_key(self, pk=None):
         setattr(self, self.__primary_key_field, pk)
 
+    def _is_modified(self):
+        return any(self.__modified.values())
+
+    def _get_storages(self):
+        return self.__storages.copy()
+
+    def _get_modified_props(self):
+        return set().union(*self.__modified.values())
+
+    def _restore_values(self, values, modified=()):
+        # set raw property values without validation, e.g. from the factory
+        # snapshot, and mark only the specified props as modified
+        with self.__lock:
+            for prop, value in values.items():
+                setattr(self, prop, value)
+            for props in chain(self.__modified.values(),
+                               self.__modified_for_sync.values()):
+                props.clear()
+            for prop in modified:
+                self.__modified[self._property_map[prop].get('store')].add(
+                    prop)
+
+    def _get_serialize_props(self, mode=None):
+        props = self.__serialize_map[mode]
+        return [prop for prop in self._property_map if prop in props]
+
+    def _get_property_map_hash(self):
+        import hashlib
+        return hashlib.sha256(
+            repr(
+                sorted((prop, sorted((k, repr(v))
+                                     for k, v in (p or {}).items()))
+                       for prop, p in self._property_map.items())).encode()
+        ).hexdigest()
+
     def __check_deleted(self):
         if self.deleted:
             raise RuntimeError('object {c} {pk} is deleted'.format(
@@ -175,8 +216,9 @@ class SmartObject(object):
         """
         return self._format_value(
             prop,
-            storage.get_storage(self._property_map[prop]['store']).get_prop(
-                self._get_primary_key(), prop))
+            aio._blocking_result(
+                storage.get_storage(self._property_map[prop]['store']).get_prop(
+                    self._get_primary_key(), prop)))
 
     def storage_set(self, prop, value):
         """
@@ -184,8 +226,9 @@ class SmartObject(object):
 
         May be used in custom getters/setters for the external properties
         """
-        storage.get_storage(self._property_map[prop]['store']).set_prop(
-            self._get_primary_key(), prop, value)
+        aio._blocking_result(
+            storage.get_storage(self._property_map[prop]['store']).set_prop(
+                self._get_primary_key(), prop, value))
 
     def _format_value(self, prop, value):
         p = self._property_map[prop]
@@ -298,7 +341,8 @@ class SmartObject(object):
                 value = self._format_value(prop, value)
                 value = self.prepare_value(prop, value)
                 external = p.get('external')
-                if external or getattr(self, prop) != value:
+                old_value = None if external else getattr(self, prop)
+                if external or old_value != value:
                     setattr(self, prop, value)
                     logger.log(
                         p.get('log-level', 20),
@@ -315,6 +359,11 @@ class SmartObject(object):
                         if 'store' in p:
                             storage_id = p['store']
                             self.__modified[storage_id].add(prop)
+                        # the factory is notified after the prop is marked
+                        # as modified, so hook errors don't lose the change
+                        if self._object_factory is not None:
+                            self._object_factory._on_prop_changed(
+                                self, prop, old_value)
                         if save: self.save()
                     return True and not external
                 else:
@@ -358,7 +407,7 @@ class SmartObject(object):
         except AttributeError:
             return getattr(self, prop)
 
-    def load(self, opts={}, **kwargs):
+    def load(self, opts={}, _data=None, _sync=True, **kwargs):
         """
         Load object data from the storage
 
@@ -372,17 +421,40 @@ class SmartObject(object):
             logger.debug('Loading {c} {pk}'.format(c=self.__class__.__name__,
                                                    pk=self._get_primary_key()))
             for storage_id in self.__storages:
+                data = aio._blocking_result(
+                    storage.get_storage(storage_id).load(
+                        pk=self._get_primary_key(),
+                        **opts)) if _data is None else _data[storage_id]
                 self.set_prop(value={
                     key: value
-                    for key, value in storage.get_storage(storage_id).load(
-                        pk=self._get_primary_key(), **opts).items()
+                    for key, value in data.items()
                     if not self._property_map[key].get('external')
                 },
                               sync=False,
                               _allow_readonly=True)
                 self.__modified[storage_id].clear()
             self.after_load(opts=opts)
-            self.sync()
+            if _sync:
+                self.sync()
+
+    async def async_load(self, opts={}, **kwargs):
+        """
+        Load object data from the storage, asyncio version
+
+        Blocking storages are called in executor. Calls self.after_load()
+        method after loading
+
+        Args:
+            opts: passed to storage.load() as kwargs
+        """
+        self.__check_deleted()
+        pk = self._get_primary_key()
+        data = {}
+        for storage_id in self.__storages:
+            data[storage_id] = await aio.call(
+                storage.get_storage(storage_id).load, pk=pk, **opts)
+        self.load(opts=opts, _data=data, _sync=False)
+        await self.async_sync()
 
     def after_load(self, opts={}, **kwargs):
         """
@@ -400,7 +472,52 @@ class SmartObject(object):
         with self.__lock:
             pk = self._get_primary_key(_allow_null=False)
             self.__check_deleted()
-            sync_tasks = {}
+            pending = self._pop_sync_data(force)
+            try:
+                for sync_id, sync_data in list(pending.items()):
+                    aio._blocking_result(
+                        sync.get_sync(sync_id).sync(pk, sync_data))
+                    self._commit_sync_data(sync_id, pending.pop(sync_id))
+            finally:
+                for sync_id, sync_data in pending.items():
+                    self._restore_sync_data(sync_id, sync_data)
+        return True
+
+    async def async_sync(self, force=False):
+        """
+        Sync object data with synchroizer, asyncio version
+
+        Blocking synchronizers are called in executor, multiple synchronizers
+        are called concurrently
+
+        Args:
+            force: force sync even if object is not modified
+        """
+        pk = self._get_primary_key(_allow_null=False)
+        self.__check_deleted()
+
+        async def sync_one(sync_id, sync_data):
+            try:
+                await aio.call(sync.get_sync(sync_id).sync, pk, sync_data)
+            except BaseException:
+                self._restore_sync_data(sync_id, sync_data)
+                raise
+            self._commit_sync_data(sync_id, sync_data)
+
+        await aio.gather(
+            sync_one(sync_id, sync_data)
+            for sync_id, sync_data in self._pop_sync_data(force).items())
+        return True
+
+    def _pop_sync_data(self, force=False):
+        # returns data to sync { sync_id: data } and clears modified props.
+        # unless forced, props with values, equal to the last delivered ones,
+        # are dropped, sync-always props are sent only together with changed
+        # ones. after the sync, data must be passed to _commit_sync_data() or
+        # to _restore_sync_data() if the sync is failed
+        with self.__lock:
+            result = {}
+            suppress = config.sync_suppress_unchanged and not force
             for sync_id, props in self.__sync_map.items(
             ) if force else self.__modified_for_sync.items():
                 sync_data = {
@@ -409,9 +526,40 @@ class SmartObject(object):
                     for key in chain(props, self.__sync_always[sync_id])
                 }
                 if not force: props.clear()
+                synced = self.__synced.setdefault(sync_id, {})
+                if suppress and sync_data:
+                    unchanged = [
+                        k for k, v in sync_data.items()
+                        if k in synced and synced[k] == v
+                    ]
+                    if len(unchanged) == len(sync_data):
+                        sync._count_suppressed(1, len(unchanged),
+                                               sync_data.values())
+                        continue
+                    always = self.__sync_always[sync_id]
+                    dropped = [k for k in unchanged if k not in always]
+                    if dropped:
+                        sync._count_suppressed(
+                            0, len(dropped), (sync_data[k] for k in dropped))
+                        for k in dropped:
+                            del sync_data[k]
                 if sync_data:
-                    sync.get_sync(sync_id).sync(pk, sync_data)
-        return True
+                    result[sync_id] = sync_data
+            return result
+
+    def _commit_sync_data(self, sync_id, data):
+        # records values, delivered to synchronizer
+        with self.__lock:
+            synced = self.__synced.setdefault(sync_id, {})
+            for k, v in data.items():
+                synced[k] = v.copy() if isinstance(v, (list, dict, set)) else v
+
+    def _restore_sync_data(self, sync_id, data):
+        # marks props of failed sync modified again
+        with self.__lock:
+            always = self.__sync_always[sync_id]
+            self.__modified_for_sync.setdefault(sync_id, set()).update(
+                k for k in data if k not in always)
 
     def save(self, force=False):
         """
@@ -425,6 +573,68 @@ class SmartObject(object):
             pk = self._get_primary_key()
             logger.debug('Saving {c} {pk}'.format(c=self.__class__.__name__,
                                                   pk=pk))
+            for storage_id, (data,
+                             modified) in self._get_save_data(force).items():
+                s = storage.get_storage(storage_id)
+                if pk is not None or s.generates_pk:
+                    npk = aio._blocking_result(
+                        s.save(pk=pk, data=data, modified=modified))
+                    self.__modified[storage_id].clear()
+                if pk is None and npk is not None:
+                    pk = npk
+                    self.set_prop(self.__primary_key_field,
+                                  pk,
+                                  _allow_readonly=True)
+
+    async def async_save(self, force=False):
+        """
+        Save object data to storage, asyncio version
+
+        Blocking storages are called in executor
+
+        Args:
+            force: force save even if object is not modified
+        """
+        self.__check_deleted()
+        pk = self._get_primary_key()
+        logger.debug('Saving {c} {pk}'.format(c=self.__class__.__name__,
+                                              pk=pk))
+        for storage_id, (data, modified) in self._get_save_data(force).items():
+            s = storage.get_storage(storage_id)
+            if pk is not None or s.generates_pk:
+                npk = await aio.call(s.save,
+                                     pk=pk,
+                                     data=data,
+                                     modified=modified)
+                self._clear_modified(storage_id, modified)
+                if pk is None and npk is not None:
+                    pk = npk
+                    self.set_prop(self.__primary_key_field,
+                                  pk,
+                                  _allow_readonly=True)
+
+    async def async_get_prop(self, prop):
+        """
+        Get property value, asyncio version
+
+        Values of external properties are got from the storage, blocking
+        storages are called in executor
+
+        Args:
+            prop: property name
+        """
+        storage_id = self.__externals.get(prop)
+        if storage_id is None:
+            return getattr(self, prop)
+        return self._format_value(
+            prop, await aio.call(
+                storage.get_storage(storage_id).get_prop,
+                self._get_primary_key(), prop))
+
+    def _get_save_data(self, force=False):
+        # returns data of modified storages { storage_id: (data, modified) }
+        with self.__lock:
+            result = {}
             for storage_id in self.__storages:
                 if self.__modified[storage_id] or force:
                     data = {
@@ -435,21 +645,41 @@ class SmartObject(object):
                         if 'store' in props and props['store'] == storage_id and
                         not props.get('external')
                     }
-                    s = storage.get_storage(storage_id)
-                    if pk is not None or s.generates_pk:
-                        npk = s.save(pk=pk,
-                                     data=data,
-                                     modified=data if force else {
-                                         key: data[key]
-                                         for key in self.__modified[storage_id]
-                                         if key in data
-                                     })
-                        self.__modified[storage_id].clear()
-                    if pk is None and npk is not None:
-                        pk = npk
-                        self.set_prop(self.__primary_key_field,
-                                      pk,
-                                      _allow_readonly=True)
+                    result[storage_id] = (data, data if force else {
+                        key: data[key]
+                        for key in self.__modified[storage_id]
+                        if key in data
+                    })
+            return result
+
+    def _clear_modified(self, storage_id, saved=None):
+        # if saved data is specified, props, changed after saving, stay
+        # modified
+        with self.__lock:
+            modified = self.__modified[storage_id]
+            if saved is None:
+                modified.clear()
+                return
+            for key, value in saved.items():
+                if key in modified and self.serialize_prop(
+                        key, target=constants.SERIALIZE_SAVE) == value:
+                    modified.discard(key)
+
+    def _set_prop_value(self, prop, value):
+        # set formatted value of non-external prop and mark it modified,
+        # returns tuple (changed, old_value)
+        p = self._property_map[prop]
+        with self.__lock:
+            self.__check_deleted()
+            old_value = getattr(self, prop)
+            if old_value == value:
+                return False, old_value
+            setattr(self, prop, value)
+            if 'sync' in p:
+                self.__modified_for_sync[p['sync']].add(prop)
+            if 'store' in p:
+                self.__modified[p['store']].add(prop)
+            return True, old_value
 
     def snapshot_create(self):
         """
@@ -502,10 +732,12 @@ class SmartObject(object):
                     self.__deleted = True
                     if pk is not None:
                         for storage_id in self.__storages:
-                            storage.get_storage(storage_id).delete(
-                                pk, self.__storage_map[storage_id])
+                            aio._blocking_result(
+                                storage.get_storage(storage_id).delete(
+                                    pk, self.__storage_map[storage_id]))
                         for sync_id in self.__syncs:
-                            sync.get_sync(sync_id).delete(pk)
+                            aio._blocking_result(
+                                sync.get_sync(sync_id).delete(pk))
 
     @property
     def deleted(self):
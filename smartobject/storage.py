@@ -1,10 +1,12 @@
 from . import config
+from . import metrics
 
 import importlib
 import threading
 import logging
 
 from functools import partial
+from itertools import islice
 
 logger = logging.getLogger('smartobject')
 
@@ -23,7 +25,7 @@ def define_storage(storage, id=None):
     """
     if id is not None and not isinstance(id, str) and not isinstance(id, int):
         raise ValueError('Storage ID must be string or integer')
-    storages[id] = storage
+    storages[id] = metrics.wrap_backend('storage', id, storage)
 
 
 def get_storage(id=None):
@@ -64,6 +66,27 @@ class AbstractStorage:
         """
         return {}
 
+    def load_many(self, pks, **kwargs):
+        """
+        Load data of multiple objects from the storage
+
+        By default, calls load() for each object. Storages may override the
+        method to load data of all objects with a single call
+
+        Args:
+            pks: list of object primary keys
+
+        Returns:
+            dict { pk: data } for the objects found in storage
+        """
+        result = {}
+        for pk in pks:
+            try:
+                result[pk] = self.load(pk, **kwargs)
+            except (FileNotFoundError, LookupError):
+                pass
+        return result
+
     def load_by_prop(self, key, prop, **kwargs):
         """
         Load object data from the storage by secondary key
@@ -87,6 +110,17 @@ class AbstractStorage:
         while False:
             yield {}
 
+    def count(self, **kwargs):
+        """
+        Get number of objects in the storage
+
+        Used to report progress of loading all objects
+
+        Returns:
+            number of objects or None if the storage can not count them
+        """
+        return None
+
     def save(self, pk, data, modified, **kwargs):
         """
         Save object data to the storage
@@ -102,6 +136,19 @@ class AbstractStorage:
         if data or modified:
             raise RuntimeError('Not implemented')
 
+    def save_many(self, items, **kwargs):
+        """
+        Save data of multiple objects to the storage
+
+        The default implementation calls save() for each object, storages can
+        override the method to save objects in batches
+
+        Args:
+            items: list of tuples (pk, data, modified)
+        """
+        for pk, data, modified in items:
+            self.save(pk=pk, data=data, modified=modified, **kwargs)
+
     def delete(self, pk, props, **kwargs):
         """
         Delete object data from the storage
@@ -158,6 +205,103 @@ class AbstractStorage:
         raise RuntimeError('Not implemented')
 
 
+class AbstractAsyncStorage:
+    """
+    Abstract asyncio storage class
+
+    Asynchronous storages can be used with async methods of objects and
+    factories only
+    """
+    generates_pk = False
+
+    async def load(self, pk, **kwargs):
+        """
+        Load object data from the storage
+
+        Args:
+            pk: object primary key
+        """
+        return {}
+
+    async def load_many(self, pks, **kwargs):
+        """
+        Load data of multiple objects from the storage
+
+        By default, calls load() for each object
+
+        Args:
+            pks: list of object primary keys
+
+        Returns:
+            dict { pk: data } for the objects found in storage
+        """
+        result = {}
+        for pk in pks:
+            try:
+                result[pk] = await self.load(pk, **kwargs)
+            except (FileNotFoundError, LookupError):
+                pass
+        return result
+
+    async def save(self, pk, data, modified, **kwargs):
+        """
+        Save object data to the storage
+
+        Args:
+            pk: object primary key
+            data: full object data
+            modified: modified properties only
+
+        Returns:
+            object primary key
+        """
+        if data or modified:
+            raise RuntimeError('Not implemented')
+
+    async def save_many(self, items, **kwargs):
+        """
+        Save data of multiple objects to the storage
+
+        The default implementation calls save() for each object
+
+        Args:
+            items: list of tuples (pk, data, modified)
+        """
+        for pk, data, modified in items:
+            await self.save(pk=pk, data=data, modified=modified, **kwargs)
+
+    async def delete(self, pk, props, **kwargs):
+        """
+        Delete object data from the storage
+
+        Args:
+            pk: object primary key
+            props: list of object properties mapped to store
+        """
+        raise RuntimeError('Not implemented')
+
+    async def get_prop(self, pk, prop, **kwargs):
+        """
+        Get single object property from the storage
+
+        Args:
+            pk: object primary key
+            prop: object property
+        """
+        raise RuntimeError('Not implemented')
+
+    async def set_prop(self, pk, prop, value, **kwargs):
+        """
+        Save single object property to the storage
+
+        Args:
+            pk: object primary key
+            prop: object property
+            value: property value
+        """
+        raise RuntimeError('Not implemented')
+
+
 class DummyStorage(AbstractStorage):
     """
     Dummy storage class with empty methods
@@ -264,6 +408,30 @@ class SQLAStorage(AbstractStorage):
             else:
                 return dict(result)
 
+    def load_many(self, pks, chunk_size=500, **kwargs):
+        """
+        Load data of multiple objects with "select ... in" queries
+
+        Args:
+            pks: list of object primary keys
+            chunk_size: max number of primary keys per query
+        """
+        result = {}
+        q = self.sa.text(
+            'select * from {table} where {pk_field} in :pks'.format(
+                table=self.table, pk_field=self.pk_field)).bindparams(
+                    self.sa.bindparam('pks', expanding=True))
+        with self.__lock:
+            db = self.get_db()
+            for i in range(0, len(pks), chunk_size):
+                for d in db.execute(q, pks=pks[i:i + chunk_size]).fetchall():
+                    d = dict(d)
+                    result[d[self.pk_field]] = d
+        if self.allow_empty:
+            for pk in pks:
+                result.setdefault(pk, {})
+        return result
+
     def load_all(self, **kwargs):
         with self.__lock:
             result = self.get_db().execute(f'select * from {self.table}')
@@ -272,6 +440,11 @@ class SQLAStorage(AbstractStorage):
                 if d is None: break
                 yield {'data': dict(d)}
 
+    def count(self, **kwargs):
+        with self.__lock:
+            return self.get_db().execute(
+                f'select count(*) from {self.table}').scalar()
+
     def load_by_prop(self, key, prop, **kwargs):
         with self.__lock:
             result = self.get_db().execute(
@@ -430,12 +603,14 @@ class AbstractFileStorage(AbstractStorage):
                              if self.dir is not None else config.storage_dir
                             ) + '/' + self.prepare_pk(pk) + '.' + self._ext
                 with open(fname, 'r' + ('b' if self._binary else '')) as fh:
-                    return self.loads(fh.read())
+                    raw = fh.read()
             except FileNotFoundError:
                 if (self.allow_empty and
                         allow_empty is not False) or allow_empty is True:
                     return {}
                 raise
+        # decode outside of the lock, so files can be loaded in parallel
+        return self.loads(raw)
 
     def list(self, pattern=None, **kwargs):
         """
@@ -448,16 +623,36 @@ class AbstractFileStorage(AbstractStorage):
         return Path(self.dir if self.dir is not None else config.storage_dir
                    ).glob(pattern if pattern is not None else f'*.{self._ext}')
 
-    def load_all(self, pattern=None, **kwargs):
-        with self.__lock:
-            for f in self.list(pattern=pattern):
-                logging.debug(f'Loading object data from {f}')
-                yield {
-                    'info': {
-                        'fname': f
-                    },
-                    'data': self.load(fname=f, allow_empty=False)
-                }
+    def count(self, pattern=None, **kwargs):
+        return sum(1 for _ in self.list(pattern=pattern))
+
+    def load_all(self, pattern=None, workers=None, chunk_size=1000, **kwargs):
+        """
+        Args:
+            pattern: file pattern (default: all files with {self.ext})
+            workers: if specified, read and decode files in the specified
+                number of threads
+            chunk_size: number of files, processed by workers at once
+        """
+        if workers:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(workers) as pool:
+                files = self.list(pattern=pattern)
+                while True:
+                    chunk = list(islice(files, chunk_size))
+                    if not chunk:
+                        break
+                    for f, data in zip(chunk, pool.map(self._load_file,
+                                                       chunk)):
+                        yield {'info': {'fname': f}, 'data': data}
+        else:
+            with self.__lock:
+                for f in self.list(pattern=pattern):
+                    yield {'info': {'fname': f}, 'data': self._load_file(f)}
+
+    def _load_file(self, fname):
+        logging.debug(f'Loading object data from {fname}')
+        return self.load(fname=fname, allow_empty=False)
 
     def cleanup(self, pks, pattern=None):
         ppks = [self.prepare_pk(pk) for pk in pks]
@@ -1,5 +1,28 @@
+from . import metrics
+
+import threading
+import logging
+
+logger = logging.getLogger('smartobject')
+
 syncs = {}
 
+suppressed = {'syncs': 0, 'props': 0, 'bytes': 0}
+"""
+Sync payload suppression counters: number of syncs skipped, number of props
+dropped from payloads and approximate size (bytes) of the dropped values
+"""
+
+_suppressed_lock = threading.Lock()
+
+
+def _count_suppressed(syncs, props, values):
+    nbytes = sum(metrics.value_size(v) for v in values)
+    with _suppressed_lock:
+        suppressed['syncs'] += syncs
+        suppressed['props'] += props
+        suppressed['bytes'] += nbytes
+
 
 def define_sync(sync, id=None):
     """
@@ -13,7 +36,7 @@ def define_sync(sync, id=None):
     """
     if id is not None and not isinstance(id, str) and not isinstance(id, int):
         raise ValueError('Sync ID must be string or integer')
-    syncs[id] = sync
+    syncs[id] = metrics.wrap_backend('sync', id, sync)
 
 
 def get_sync(id=None):
@@ -46,6 +69,19 @@ class AbstractSync:
         """
         raise RuntimeError('not implemented')
 
+    def sync_many(self, items, **kwargs):
+        """
+        Sync data of multiple objects
+
+        The default implementation calls sync() for each object,
+        synchronizers can override the method to send data in batches
+
+        Args:
+            items: list of tuples (pk, data)
+        """
+        for pk, data in items:
+            self.sync(pk, data, **kwargs)
+
     def delete(self, pk, **kwargs):
         """
         Delete object data
@@ -58,6 +94,46 @@ class AbstractSync:
         raise RuntimeError('not implemented')
 
 
+class AbstractAsyncSync:
+    """
+    Abstract asyncio synchronizer class
+
+    Asynchronous synchronizers can be used with async methods of objects and
+    factories only
+    """
+
+    async def sync(self, pk, data={}, **kwargs):
+        """
+        Sync object data
+
+        Args:
+            pk: object primary key
+            data: object data to sync
+        """
+        raise RuntimeError('not implemented')
+
+    async def sync_many(self, items, **kwargs):
+        """
+        Sync data of multiple objects
+
+        The default implementation calls sync() for each object
+
+        Args:
+            items: list of tuples (pk, data)
+        """
+        for pk, data in items:
+            await self.sync(pk, data, **kwargs)
+
+    async def delete(self, pk, **kwargs):
+        """
+        Delete object data
+
+        Args:
+            pk: object primary key
+        """
+        raise RuntimeError('not implemented')
+
+
 class DummySync:
     """
     Dummy synchronizer class with empty methods
@@ -70,3 +146,142 @@ class DummySync:
 
     def delete(self, pk, **kwargs):
         return True
+
+
+def _process_sync_worker(sync, queue):
+    # runs in worker process, payloads are processed in the queue order
+    while True:
+        item = queue.get()
+        try:
+            if item is None:
+                return
+            op, args = item
+            try:
+                getattr(sync, op)(*args)
+            except Exception as e:
+                logger.error(f'Sync worker {op} error: {e}')
+        finally:
+            queue.task_done()
+
+
+class ProcessSync:
+    """
+    Synchronizer, which runs another synchronizer in worker processes
+
+    Payloads are sent to workers through queues and synced in background, so
+    CPU-bound synchronizers (encoders, compressors etc.) do not load the
+    calling threads. Payloads of the same object are always processed by the
+    same worker in the order they are sent. Errors of the real synchronizer
+    are logged by workers.
+    """
+
+    def __init__(self,
+                 sync,
+                 workers=2,
+                 queue_size=1000,
+                 put_timeout=None,
+                 start_method=None):
+        """
+        Args:
+            sync: synchronizer object, must be picklable unless start method
+                is "fork"
+            workers: number of worker processes
+            queue_size: max number of queued payloads per worker, if the
+                queue is full, sync calls block (backpressure)
+            put_timeout: max time to wait for free queue slot (default: wait
+                forever)
+            start_method: multiprocessing start method (default: platform
+                default)
+        Raises:
+            RuntimeError: if the queue is full after put_timeout
+        """
+        import multiprocessing
+        ctx = multiprocessing.get_context(start_method)
+        self.put_timeout = put_timeout
+        # synchronizers may not implement batch syncs
+        self._batch = callable(getattr(sync, 'sync_many', None))
+        self._queues = [ctx.JoinableQueue(queue_size) for _ in range(workers)]
+        self._processes = [
+            ctx.Process(target=_process_sync_worker,
+                        args=(sync, q),
+                        daemon=True) for q in self._queues
+        ]
+        for p in self._processes:
+            p.start()
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def _put(self, i, item):
+        import queue
+        if self._stopped:
+            raise RuntimeError('Sync workers are stopped')
+        elif not self._processes[i].is_alive():
+            raise RuntimeError(f'Sync worker {i} is not running')
+        try:
+            self._queues[i].put(item, timeout=self.put_timeout)
+        except queue.Full:
+            raise RuntimeError(f'Sync worker {i} queue is full')
+
+    def _worker(self, pk):
+        return hash(pk) % len(self._queues)
+
+    def sync(self, pk, data={}, **kwargs):
+        self._put(self._worker(pk), ('sync', (pk, data)))
+        return True
+
+    def sync_many(self, items, **kwargs):
+        if not self._batch:
+            for pk, data in items:
+                self.sync(pk, data)
+            return True
+        batches = {}
+        for pk, data in items:
+            batches.setdefault(self._worker(pk), []).append((pk, data))
+        for i, batch in batches.items():
+            self._put(i, ('sync_many', (batch,)))
+        return True
+
+    def delete(self, pk, **kwargs):
+        self._put(self._worker(pk), ('delete', (pk,)))
+        return True
+
+    def flush(self):
+        """
+        Wait until all queued payloads are processed
+        """
+        for q in self._queues:
+            q.join()
+
+    def stop(self, timeout=None):
+        """
+        Stop worker processes
+
+        Queued payloads are processed before workers exit
+
+        Args:
+            timeout: max time to wait for each worker, workers, which are
+                still running after timeout, are terminated
+        """
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+        for q, p in zip(self._queues, self._processes):
+            if p.is_alive():
+                q.put(None)
+        for q, p in zip(self._queues, self._processes):
+            p.join(timeout)
+            if p.is_alive():
+                logger.warning(f'Sync worker {p.pid} terminated')
+                p.terminate()
+                p.join()
+                # payloads left in the queue buffer are dropped
+                q.cancel_join_thread()
+            q.close()
+            q.join_thread()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
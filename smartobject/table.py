@@ -0,0 +1,616 @@
+from . import storage
+from . import sync
+from . import aio
+
+from .smartobject import SmartObject
+
+import importlib
+import threading
+import logging
+
+from array import array
+
+logger = logging.getLogger('smartobject')
+
+# array module type codes for numeric columns, if NumPy is not available
+_ARRAY_TYPES = {int: 'q', float: 'd'}
+
+
+class SmartObjectTable:
+    """
+    Columnar container for large collections of objects of the same class
+
+    Instead of keeping an instance per object, the table keeps a column per
+    object property and a primary key to row index. The table is driven by
+    the property map of the object class.
+
+    Numeric and boolean props with non-null defaults are stored in NumPy
+    arrays (or typed arrays, if NumPy is not installed), other props in lists.
+    External props, prop getters and serialize_{prop} methods are not
+    supported. Objects must have primary keys set before they are appended
+    """
+
+    def __init__(self, object_class, opts={}, use_numpy=None, capacity=1024):
+        """
+        Args:
+            object_class: Smart Object class
+            opts: kwargs for the object class constructor, used to create a
+                template object, which property map is used
+            use_numpy: store numeric props in NumPy arrays (default: if NumPy
+                is installed)
+            capacity: initial number of rows allocated in NumPy arrays
+        """
+        self.np = None
+        if use_numpy is not False:
+            try:
+                self.np = importlib.import_module('numpy')
+            except ModuleNotFoundError:
+                if use_numpy:
+                    raise
+        self._object_class = object_class
+        self._template = object_class(**opts)
+        # values are prepared one-by-one if the class has a custom preparer
+        self._prepare = type(
+            self._template).prepare_value is not SmartObject.prepare_value
+        self._property_map = {
+            k: v
+            for k, v in self._template._property_map.items()
+            if not v.get('external')
+        }
+        self._pk_field = next(
+            k for k, v in self._property_map.items() if v.get('pk'))
+        self._storages = self._template._get_storages()
+        self._storage_map = {}
+        self._sync_map = {}
+        self._sync_always = {}
+        self._serialize_map = {None: list(self._property_map)}
+        for prop, p in self._property_map.items():
+            if 'store' in p and p['store'] is not False:
+                self._storage_map.setdefault(p['store'], []).append(prop)
+            if 'sync' in p and p['sync'] is not False:
+                self._sync_map.setdefault(p['sync'], [])
+                self._sync_always.setdefault(p['sync'], [])
+                (self._sync_always if p.get('sync-always') else
+                 self._sync_map)[p['sync']].append(prop)
+            ser = p.get('serialize')
+            if ser:
+                for s in ser if isinstance(ser, list) else [ser]:
+                    self._serialize_map.setdefault(s, []).append(prop)
+        self._capacity = capacity
+        self._size = 0
+        self._index = {}
+        self._columns = {}
+        self._kinds = {}
+        for prop, p in self._property_map.items():
+            tp = p.get('type')
+            if tp in (int, float, bool) and p.get('default') is not None and \
+                    not p.get('pk'):
+                if self.np is not None:
+                    self._columns[prop] = self.np.full(capacity,
+                                                       p['default'],
+                                                       dtype=tp)
+                    self._kinds[prop] = 'numpy'
+                    continue
+                elif tp in _ARRAY_TYPES:
+                    self._columns[prop] = array(_ARRAY_TYPES[tp])
+                    self._kinds[prop] = 'array'
+                    continue
+            self._columns[prop] = []
+            self._kinds[prop] = 'list'
+        # modified props of rows: { storage_or_sync_id: { pk: set(props) } }
+        self._modified = {s: {} for s in self._storages}
+        self._modified_for_sync = {s: {} for s in self._sync_map}
+        self.__lock = threading.RLock()
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, pk):
+        return pk in self._index
+
+    def __iter__(self):
+        with self.__lock:
+            pks = list(self._index)
+        return (TableRow(self, pk) for pk in pks)
+
+    def _get_prop_map(self, prop, _allow_readonly=True):
+        p = self._property_map.get(prop)
+        if p is None:
+            raise AttributeError(f'no such property: "{prop}" in table of '
+                                 f'"{self._object_class.__name__}"')
+        if p.get('read-only') and not _allow_readonly:
+            raise AttributeError(f'property "{prop}" is read-only in table of '
+                                 f'"{self._object_class.__name__}"')
+        return p
+
+    def validate(self, prop, values):
+        """
+        Validate and format values of the property
+
+        Values are validated as a whole: NumPy columns are checked with
+        vectorized type conversion, min/max and choices checks, other values
+        are validated one-by-one as SmartObject.set_prop() does
+
+        Args:
+            prop: object property
+            values: list or array of values
+
+        Returns:
+            values, formatted for the property column
+
+        Raises:
+            AttributeError: if no such property
+            ValueError: if any value is invalid
+        """
+        p = self._get_prop_map(prop)
+        kind = self._kinds[prop]
+        if kind == 'numpy' and not self._prepare:
+            np = self.np
+            try:
+                if p['type'] is bool:
+                    arr = np.asarray(values)
+                    if arr.dtype != bool:
+                        raise ValueError
+                else:
+                    arr = np.asarray(values, dtype=p['type'])
+                bad = np.zeros(len(arr), dtype=bool)
+                if p['type'] is not bool:
+                    if p.get('min') is not None:
+                        bad |= arr < p['min']
+                    if p.get('max') is not None:
+                        bad |= arr > p['max']
+                if 'choices' in p:
+                    bad |= ~np.isin(arr, list(p['choices']))
+                if not bad.any():
+                    return arr
+            except (TypeError, ValueError, OverflowError):
+                pass
+        # the slow path, also reports the invalid value
+        t = self._template
+        default = p.get('default')
+        result = []
+        for v in values:
+            if v is None:
+                v = default
+            v = t._format_value(prop, v)
+            if self._prepare:
+                v = t.prepare_value(prop, v)
+            result.append(v)
+        if kind == 'numpy':
+            return self.np.asarray(result, dtype=p['type'])
+        elif kind == 'array':
+            return array(_ARRAY_TYPES[p['type']], result)
+        else:
+            return result
+
+    def _reserve(self, n):
+        need = self._size + n
+        if need > self._capacity:
+            self._capacity = max(need, self._capacity * 2)
+            for prop, kind in self._kinds.items():
+                if kind == 'numpy':
+                    old = self._columns[prop]
+                    col = self.np.full(self._capacity,
+                                       self._property_map[prop]['default'],
+                                       dtype=old.dtype)
+                    col[:self._size] = old[:self._size]
+                    self._columns[prop] = col
+
+    def extend(self, rows, modified=True):
+        """
+        Append objects to the table
+
+        Args:
+            rows: list of dicts with object data, primary keys are required
+            modified: mark the objects modified, so they are saved and
+                synced on the next save() / sync() (default: True)
+
+        Raises:
+            ValueError: if data is invalid, primary key is not set or the
+                object with such key already exists
+        """
+        columns = {
+            prop: self.validate(prop, [r.get(prop) for r in rows])
+            for prop in self._property_map
+        }
+        pks = columns[self._pk_field]
+        with self.__lock:
+            seen = set()
+            for pk in pks:
+                if pk is None:
+                    raise ValueError('Object has no primary key')
+                if pk in self._index or pk in seen:
+                    raise ValueError(f'Object already exists: {pk}')
+                seen.add(pk)
+            n = len(pks)
+            self._reserve(n)
+            size = self._size
+            for prop, values in columns.items():
+                if self._kinds[prop] == 'numpy':
+                    self._columns[prop][size:size + n] = values
+                else:
+                    self._columns[prop].extend(values)
+            for i, pk in enumerate(pks):
+                self._index[pk] = size + i
+            self._size += n
+            if modified:
+                for modified_props, props_map in (
+                    (self._modified, self._storage_map),
+                    (self._modified_for_sync, self._sync_map)):
+                    for i, m in modified_props.items():
+                        props = props_map.get(i, ())
+                        for pk in pks:
+                            m[pk] = set(props)
+        logger.debug(f'{n} {self._object_class.__name__} objects appended to '
+                     'table')
+
+    def append(self, data, modified=True):
+        """
+        Append object to the table
+
+        Args:
+            data: dict with object data, primary key is required
+            modified: mark the object modified (default: True)
+
+        Returns:
+            table row object
+        """
+        self.extend([data], modified=modified)
+        return TableRow(self, data[self._pk_field])
+
+    def get(self, pk):
+        """
+        Get table row
+
+        Args:
+            pk: object primary key
+
+        Returns:
+            table row object, which can be used as Smart Object
+
+        Raises:
+            KeyError: if object with such primary key doesn't exist
+        """
+        with self.__lock:
+            if pk not in self._index:
+                raise KeyError(pk)
+        return TableRow(self, pk)
+
+    def get_prop(self, pk, prop):
+        """
+        Get single property value of the object
+        """
+        self._get_prop_map(prop)
+        with self.__lock:
+            value = self._columns[prop][self._index[pk]]
+        return value.item() if self._kinds[prop] == 'numpy' else value
+
+    def get_values(self, prop, pks=None):
+        """
+        Get property values of multiple objects
+
+        Args:
+            prop: object property
+            pks: list of primary keys (default: all objects)
+
+        Returns:
+            NumPy array, typed array or list of values
+        """
+        self._get_prop_map(prop)
+        with self.__lock:
+            col = self._columns[prop]
+            kind = self._kinds[prop]
+            if pks is None:
+                return col[:self._size].copy() if kind == 'numpy' else col[:]
+            rows = [self._index[pk] for pk in pks]
+            if kind == 'numpy':
+                return col[rows]
+            result = [col[r] for r in rows]
+            return array(col.typecode, result) if kind == 'array' else result
+
+    def set_values(self,
+                   prop,
+                   values,
+                   pks=None,
+                   save=False,
+                   sync=True,
+                   _allow_readonly=False):
+        """
+        Set property values of multiple objects
+
+        Args:
+            prop: object property
+            values: list or array of values, or a single value for all
+                objects
+            pks: list of primary keys (default: all objects)
+            save: save modified objects
+            sync: sync modified objects
+
+        Returns:
+            number of objects modified
+
+        Raises:
+            AttributeError: if no such property or property is read-only
+            ValueError: if any value is invalid
+            KeyError: if object doesn't exist
+        """
+        p = self._get_prop_map(prop, _allow_readonly=_allow_readonly)
+        if prop == self._pk_field:
+            raise AttributeError('primary key can not be changed')
+        with self.__lock:
+            if pks is None:
+                rows = list(range(self._size))
+            else:
+                rows = [self._index[pk] for pk in pks]
+            if isinstance(values, (list, tuple, array)) or (
+                    self.np is not None and
+                    isinstance(values, self.np.ndarray)):
+                if len(values) != len(rows):
+                    raise ValueError('number of values and objects differ')
+            else:
+                values = [values] * len(rows)
+            values = self.validate(prop, values)
+            col = self._columns[prop]
+            pk_col = self._columns[self._pk_field]
+            if self._kinds[prop] == 'numpy':
+                np = self.np
+                rows = np.asarray(rows, dtype=np.intp)
+                changed = rows[col[rows] != values]
+                col[rows] = values
+                changed = [pk_col[r] for r in changed.tolist()]
+            else:
+                changed = []
+                for r, v in zip(rows, values):
+                    if col[r] != v:
+                        col[r] = v
+                        changed.append(pk_col[r])
+            if changed:
+                logger.log(
+                    p.get('log-level', 20),
+                    f'Setting {self._object_class.__name__} {prop} '
+                    f'for {len(changed)} objects')
+            for m, i in ((self._modified, p.get('store', False)),
+                         (self._modified_for_sync, p.get('sync', False))):
+                if i is not False and i in m:
+                    for pk in changed:
+                        m[i].setdefault(pk, set()).add(prop)
+        if changed:
+            if sync:
+                self.sync(changed)
+            if save:
+                self.save(changed)
+        return len(changed)
+
+    def _row_data(self, row, props):
+        result = {}
+        for prop in props:
+            value = self._columns[prop][row]
+            result[prop] = value.item() if self._kinds[prop] == 'numpy' \
+                    else value
+        return result
+
+    def serialize(self, pk, mode=None):
+        """
+        Serialize object
+
+        Args:
+            pk: object primary key
+            mode: serialization mode. if not specified, all object properties
+                are serialized
+        """
+        with self.__lock:
+            return self._row_data(self._index[pk], self._serialize_map[mode])
+
+    def save(self, pks=None, force=False):
+        """
+        Save objects to storages
+
+        Args:
+            pks: list of primary keys (default: all modified objects)
+            force: save objects even if they are not modified
+        """
+        with self.__lock:
+            for storage_id in self._storages:
+                modified = self._modified[storage_id]
+                s = storage.get_storage(storage_id)
+                props = self._storage_map.get(storage_id, [])
+                if pks is not None:
+                    targets = pks
+                elif force:
+                    targets = list(self._index)
+                else:
+                    targets = list(modified)
+                for pk in targets:
+                    m = modified.get(pk)
+                    if not m and not force:
+                        continue
+                    data = self._row_data(self._index[pk], props)
+                    aio._blocking_result(
+                        s.save(pk=pk,
+                               data=data,
+                               modified=data if force else
+                               {k: data[k] for k in m if k in data}))
+                    modified.pop(pk, None)
+
+    def sync(self, pks=None, force=False):
+        """
+        Sync objects with synchronizers
+
+        Args:
+            pks: list of primary keys (default: all modified objects)
+            force: sync objects even if they are not modified
+        """
+        with self.__lock:
+            for sync_id, modified in self._modified_for_sync.items():
+                s = sync.get_sync(sync_id)
+                if pks is not None:
+                    targets = pks
+                elif force:
+                    targets = list(self._index)
+                else:
+                    targets = list(modified)
+                for pk in targets:
+                    m = self._sync_map[sync_id] if force else modified.get(
+                        pk, ())
+                    props = set(m).union(self._sync_always[sync_id])
+                    if props:
+                        aio._blocking_result(
+                            s.sync(pk, self._row_data(self._index[pk],
+                                                      props)))
+                    modified.pop(pk, None)
+
+    def remove(self, pk):
+        """
+        Remove object from the table
+
+        Args:
+            pk: object primary key
+        """
+        with self.__lock:
+            row = self._index.pop(pk)
+            last = self._size - 1
+            pk_col = self._columns[self._pk_field]
+            if row != last:
+                # move the last row to the removed one
+                self._index[pk_col[last]] = row
+                for col in self._columns.values():
+                    col[row] = col[last]
+            for prop, col in self._columns.items():
+                if self._kinds[prop] != 'numpy':
+                    col.pop()
+            self._size = last
+            for m in self._modified.values():
+                m.pop(pk, None)
+            for m in self._modified_for_sync.values():
+                m.pop(pk, None)
+
+    def delete(self, pk):
+        """
+        Delete object from storages and synchronizers and remove it from the
+        table
+
+        Args:
+            pk: object primary key
+        """
+        with self.__lock:
+            self.remove(pk)
+            for storage_id in self._storages:
+                aio._blocking_result(
+                    storage.get_storage(storage_id).delete(
+                        pk, self._storage_map.get(storage_id, [])))
+            for sync_id in self._sync_map:
+                aio._blocking_result(sync.get_sync(sync_id).delete(pk))
+
+    def update(self, pk, data, save=False, sync=True, _allow_readonly=False):
+        """
+        Set multiple properties of the object
+
+        All values are validated before any property is changed
+
+        Args:
+            pk: object primary key
+            data: dict { prop: value }
+            save: save object if modified
+            sync: sync object if modified
+
+        Returns:
+            True if any property is changed, False if unchanged
+        """
+        for prop in data:
+            self._get_prop_map(prop, _allow_readonly=_allow_readonly)
+        values = {prop: self.validate(prop, [v]) for prop, v in data.items()}
+        result = False
+        with self.__lock:
+            for prop, v in values.items():
+                result = self.set_values(prop,
+                                         v, [pk],
+                                         sync=False,
+                                         _allow_readonly=_allow_readonly
+                                        ) > 0 or result
+        if result:
+            if sync:
+                self.sync([pk])
+            if save:
+                self.save([pk])
+        return result
+
+
+class TableRow:
+    """
+    Lightweight proxy of a table row, which can be used as Smart Object
+
+    Property values are available as attributes. Rows don't hold the data, so
+    they are created on demand and can be dropped at any time
+    """
+    __slots__ = ('_table', '_pk')
+
+    def __init__(self, table, pk):
+        self._table = table
+        self._pk = pk
+
+    def __getattr__(self, name):
+        return self._table.get_prop(self._pk, name)
+
+    def __setattr__(self, name, value):
+        if name in self.__slots__:
+            object.__setattr__(self, name, value)
+        else:
+            raise AttributeError('use set_prop() to change table rows')
+
+    def __repr__(self):
+        return (f'<{self._table._object_class.__name__} table row '
+                f'{self._pk!r}>')
+
+    def _get_primary_key(self):
+        return self._pk
+
+    def set_prop(self, prop=None, value=None, save=False, sync=True):
+        """
+        Set object property by prop/value
+
+        To set multiple properties at once, specify value as dict
+
+        Returns:
+            True if property is set, False if unchanged
+        """
+        if isinstance(prop, dict) and value is None:
+            value = prop
+            prop = None
+        if prop is None:
+            if not isinstance(value, dict):
+                raise ValueError('prop is not specified')
+            return self._table.update(self._pk, value, save=save, sync=sync)
+        return self._table.update(self._pk, {prop: value},
+                                  save=save,
+                                  sync=sync)
+
+    def serialize(self, mode=None):
+        """
+        Serialize object
+        """
+        return self._table.serialize(self._pk, mode=mode)
+
+    def save(self, force=False):
+        """
+        Save object data to storage
+        """
+        self._table.save([self._pk], force=force)
+
+    def sync(self, force=False):
+        """
+        Sync object data with synchroizer
+        """
+        self._table.sync([self._pk], force=force)
+
+    def delete(self):
+        """
+        Delete object
+        """
+        self._table.delete(self._pk)
+
+    @property
+    def alive(self):
+        """
+        Is object alive
+        """
+        return self._pk in self._table
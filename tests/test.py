@@ -380,6 +380,742 @@ def test_load_from_dir():
     assert factory.get(key).salary == 150 * 100
 
 
+@pytest.mark.parametrize(('tp'), ('JSONStorage', 'SQLAStorage'))
+def test_factory_warmup(tp):
+    clean()
+    if tp == 'SQLAStorage':
+        storage = smartobject.SQLAStorage(_prepare_t2_db(), 't2')
+    else:
+        storage = smartobject.JSONStorage()
+    smartobject.define_storage(storage)
+    factory = smartobject.SmartObjectFactory(T2, autosave=True)
+    factory.add_index('login')
+    ids = []
+    for i in range(25):
+        obj = factory.create()
+        obj.set_prop('login', f'test{i % 5}', save=True)
+        ids.append(obj.id)
+    factory.clear()
+    reports = []
+    loaded = factory.warmup(
+        workers=3,
+        chunk_size=4,
+        load_opts={'workers': 2} if tp == 'JSONStorage' else {},
+        progress=lambda *args: reports.append(args))
+    assert loaded == 25
+    assert sorted(factory.get()) == sorted(ids)
+    assert len(factory.get('test1', prop='login')) == 5
+    assert reports[-1][:2] == (25, 25)
+    assert reports[-1][3] == 0
+
+
+def test_factory_warmup_no_count(backends):
+
+    class Storage:
+
+        def load_all(self, **kwargs):
+            return ({'data': {'id': f'd{i}'}} for i in range(5))
+
+    smartobject.define_storage(Storage())
+    factory = smartobject.SmartObjectFactory(Device)
+    reports = []
+    assert factory.warmup(progress=lambda *args: reports.append(args)) == 5
+    assert reports[-1][:2] == (5, None)
+    assert reports[-1][3] is None
+
+def test_factory_snapshot():
+    clean()
+    smartobject.define_storage(smartobject.JSONStorage())
+    factory = smartobject.SmartObjectFactory(T2)
+    factory.add_index('login', sorted=True)
+    ids = []
+    for i in range(10):
+        obj = factory.create(save=True)
+        obj.set_prop('login', f'test{i}', save=i > 0)
+        ids.append(obj.id)
+    assert factory.dump_snapshot('test_data/t2.snapshot') == 10
+    factory = smartobject.SmartObjectFactory(T2)
+    assert factory.restore_snapshot('test_data/t2.snapshot') == 10
+    assert list(factory.get()) == ids
+    assert factory.get('test3', prop='login')[0].id == ids[3]
+    assert len(factory.find('login', ge='test5')) == 5
+    # unsaved changes are kept
+    assert factory.get(ids[0])._is_modified()
+    assert not factory.get(ids[1])._is_modified()
+    with pytest.raises(RuntimeError):
+        factory.restore_snapshot('test_data/t2.snapshot')
+
+
+def test_factory_metrics():
+    clean()
+    storage = smartobject.JSONStorage()
+    storage.allow_empty = False
+    smartobject.define_storage(storage)
+    events = []
+    metrics = smartobject.FactoryMetrics(
+        callback=lambda name, value: events.append(name))
+    factory = smartobject.SmartObjectFactory(T2,
+                                             autoload=True,
+                                             maxsize=1,
+                                             metrics=metrics)
+    factory.add_index('login')
+    o1 = factory.create(save=True)
+    factory.create(save=True)
+    factory.get(o1.id)
+    with pytest.raises(FileNotFoundError):
+        factory.get('missing')
+    factory.get('test', prop='login')
+    stats = factory.stats()
+    assert stats['objects'] == 1
+    assert stats['indexes'] == {'login': 0}
+    assert stats['creates'] == 3
+    assert stats['evictions_size'] == 2
+    assert stats['hits'] == 0
+    assert stats['misses'] == 2
+    assert stats['autoloads'] == 1
+    assert stats['autoload_errors'] == 1
+    assert stats['prop_misses'] == 1
+    assert stats['autoload_time']['count'] == 2
+    assert 'evictions_size' in events
+    assert stats['removes'] == 0
+    o = factory.get(o1.id)
+    with pytest.raises(RuntimeError):
+        factory.create(obj=T2(o1.id))
+    factory.remove(o)
+    stats = factory.stats()
+    # the duplicate is not inserted
+    assert stats['creates'] == 3
+    assert stats['removes'] == 1
+    factory = smartobject.SmartObjectFactory(T2, maxsize=0, metrics=True)
+    factory.create(save=True)
+    assert factory.stats()['creates'] == 0
+    assert smartobject.SmartObjectFactory(T2).metrics is None
+
+
+def test_backend_metrics():
+    clean()
+    smartobject.define_storage(smartobject.JSONStorage())
+    smartobject.define_sync(smartobject.DummySync())
+    metrics = smartobject.metrics.instrument()
+    try:
+        smartobject.define_storage(smartobject.PickleStorage(), 'pickle')
+        obj = T2()
+        obj.set_prop('login', 'test')
+        obj.save()
+        obj.load()
+        Employee('John Doe').set_prop('personal_code', 99)
+        stats = metrics.stats()
+        assert stats['storage'][None]['save']['calls'] == 1
+        assert stats['storage'][None]['save']['payload_bytes'] > 0
+        assert stats['storage'][None]['load']['time']['count'] == 1
+        assert stats['sync'][None]['sync']['calls'] == 1
+        text = metrics.prometheus()
+        assert ('smartobject_backend_calls_total{kind="storage",'
+                'backend="default",op="save"} 1') in text
+        assert isinstance(smartobject.get_storage('pickle'),
+                          smartobject.metrics.InstrumentedBackend)
+    finally:
+        smartobject.metrics.uninstrument()
+    assert isinstance(smartobject.get_storage(), smartobject.JSONStorage)
+
+
+class Device(smartobject.SmartObject):
+
+    def __init__(self, id=None):
+        self.id = id
+        self.load_property_map({
+            'id': {
+                'pk': True,
+                'type': str
+            },
+            'battery': {
+                'type': int,
+                'default': 100,
+                'min': 0,
+                'max': 100,
+                'store': True,
+                'sync': True
+            },
+            'status': {
+                'type': str,
+                'default': 'ok',
+                'choices': ['ok', 'error'],
+                'store': True,
+                'serialize': 'info'
+            }
+        })
+        self.apply_property_map()
+
+
+class RecorderStorage(smartobject.DummyStorage):
+    """
+    Keeps object data in memory, records saves and batches
+    """
+
+    def __init__(self, data=None):
+        self.data = {} if data is None else data
+        self.saved = {}
+        self.batches = []
+        self.loads = 0
+
+    def load(self, pk, **kwargs):
+        self.loads += 1
+        try:
+            return self.data[pk].copy()
+        except KeyError:
+            raise LookupError(pk)
+
+    def load_by_prop(self, key, prop, **kwargs):
+        return [{
+            'data': dict(data, id=pk)
+        } for pk, data in self.data.items() if data.get(prop) == key]
+
+    def save(self, pk, data, modified, **kwargs):
+        self.data[pk] = data
+        self.saved[pk] = modified
+
+    def save_many(self, items, **kwargs):
+        self.batches.append(items)
+        super().save_many(items, **kwargs)
+
+
+class AsyncRecorderStorage(smartobject.AbstractAsyncStorage):
+    """
+    Asynchronous version of RecorderStorage
+    """
+
+    def __init__(self, data=None):
+        self.data = {} if data is None else data
+        self.loads = 0
+
+    async def load(self, pk, **kwargs):
+        import asyncio
+        self.loads += 1
+        await asyncio.sleep(0.01)
+        try:
+            return self.data[pk].copy()
+        except KeyError:
+            raise LookupError(pk)
+
+    async def save(self, pk, data, modified, **kwargs):
+        self.data[pk] = data
+
+
+class RecorderSync(smartobject.AbstractSync):
+    """
+    Records synced payloads (pk, data) and batches, fails if fail is set
+    """
+
+    def __init__(self):
+        self.synced = []
+        self.batches = []
+        self.fail = False
+
+    def sync(self, pk, data, **kwargs):
+        if self.fail:
+            raise ConnectionError(pk)
+        self.synced.append((pk, data))
+
+    def sync_many(self, items, **kwargs):
+        if self.fail:
+            raise ConnectionError
+        self.batches.append(items)
+        super().sync_many(items, **kwargs)
+
+
+@pytest.fixture
+def backends():
+    """
+    Defines recorder storage and sync as defaults, restores dummies after the
+    test
+    """
+    storage = RecorderStorage()
+    s = RecorderSync()
+    smartobject.define_storage(storage)
+    smartobject.define_sync(s)
+    yield storage, s
+    smartobject.define_storage(smartobject.DummyStorage())
+    smartobject.define_sync(smartobject.DummySync())
+
+
+@pytest.mark.parametrize('use_numpy', [None, False])
+def test_table(use_numpy, backends):
+    storage, s = backends
+    table = smartobject.SmartObjectTable(Device,
+                                         use_numpy=use_numpy,
+                                         capacity=2)
+    table.extend([{'id': f'd{i}', 'battery': i} for i in range(10)],
+                 modified=False)
+    assert len(table) == 10
+    assert list(table.get_values('battery', ['d2', 'd5'])) == [2, 5]
+    assert table.set_values('battery', [50, 5], ['d2', 'd5'], save=True) == 1
+    assert storage.saved == {'d2': {'battery': 50}}
+    assert s.synced == [('d2', {'battery': 50})]
+    with pytest.raises(ValueError):
+        table.set_values('battery', [1, 101], ['d1', 'd2'])
+    with pytest.raises(ValueError):
+        table.set_values('status', 'unknown')
+    assert table.get('d2').battery == 50
+    assert table.set_values('status', 'error') == 10
+    row = table.get('d3')
+    assert row.set_prop({'battery': '7', 'status': 'ok'}) is True
+    assert row.serialize() == {'id': 'd3', 'battery': 7, 'status': 'ok'}
+    assert row.serialize('info') == {'status': 'ok'}
+    table.save()
+    assert len(storage.saved) == 10
+    assert storage.saved['d3'] == {'battery': 7, 'status': 'ok'}
+    table.remove('d0')
+    assert 'd0' not in table
+    assert table.get('d9').battery == 9
+    assert sorted(r.id for r in table) == [f'd{i}' for i in range(1, 10)]
+
+
+def test_factory_set_prop_many(backends):
+    storage, s = backends
+    factory = smartobject.SmartObjectFactory(Device)
+    factory.add_index('battery')
+    for i in range(5):
+        factory.create(opts={'id': f'd{i}'})
+    pks = [f'd{i}' for i in range(5)]
+    factory.save_many()
+    assert len(storage.batches) == 1
+    assert len(storage.batches[0]) == 5
+    with pytest.raises(ValueError):
+        factory.set_prop_many(pks, 'battery', [50, 50, 50, 50, 200])
+    assert factory.get('d4').battery == 100
+    assert factory.set_prop_many(pks, 'battery', [50, 50, 50, 100, 100],
+                                 save=True) == 3
+    assert s.batches[-1] == [('d0', {'battery': 50}), ('d1', {'battery': 50}),
+                             ('d2', {'battery': 50})]
+    assert storage.batches[-1][0] == ('d0', {
+        'battery': 50,
+        'status': 'ok'
+    }, {
+        'battery': 50
+    })
+    assert len(factory.get(50, prop='battery')) == 3
+    assert factory.set_prop_many(pks, 'status', 'error') == 5
+    with pytest.raises(KeyError):
+        factory.set_prop_many(['d0', 'x'], 'status', 'ok')
+    with pytest.raises(AttributeError):
+        factory.set_prop_many(pks, 'id', 'x')
+
+
+def test_factory_save_many_concurrent_change(backends):
+    storage = backends[0]
+    factory = smartobject.SmartObjectFactory(Device)
+    d = factory.create(obj=Device('d1'))
+    d.set_prop('battery', 50, sync=False)
+    save_many = storage.save_many
+
+    def save_and_change(items, **kwargs):
+        save_many(items, **kwargs)
+        # props are changed by another thread while saving
+        d.set_prop({'battery': 60, 'status': 'error'}, sync=False)
+
+    storage.save_many = save_and_change
+    factory.save_many()
+    assert storage.data['d1'] == {'battery': 50, 'status': 'ok'}
+    assert d._is_modified()
+    storage.save_many = save_many
+    factory.save_many()
+    assert storage.data['d1'] == {'battery': 60, 'status': 'error'}
+    assert not d._is_modified()
+
+
+@pytest.mark.parametrize('format', ['ndjson', 'msgpack'])
+def test_factory_export_import(format):
+    import io
+    factory = smartobject.SmartObjectFactory(Device)
+    for i in range(25):
+        factory.create(opts={'id': f'd{i}'}).set_prop('battery', i)
+    stream = io.StringIO() if format == 'ndjson' else io.BytesIO()
+    assert factory.export(stream, format=format, chunk_size=10) == 25
+    if format == 'ndjson':
+        assert len(stream.getvalue().splitlines()) == 25
+    stream.seek(0)
+    factory2 = smartobject.SmartObjectFactory(Device)
+    factory2.add_index('battery')
+    assert factory2.import_(stream, format=format, chunk_size=10) == 25
+    assert list(factory2.get()) == list(factory.get())
+    assert factory2.get(7, prop='battery')[0].id == 'd7'
+    assert factory2.get('d3').serialize() == factory.get('d3').serialize()
+
+
+def test_factory_export_bytes():
+    import io
+
+    class Blob(smartobject.SmartObject):
+
+        def __init__(self, id=None):
+            self.id = id
+            self.load_property_map({
+                'id': {
+                    'pk': True,
+                    'type': str
+                },
+                'data': {
+                    'type': bytes
+                }
+            })
+            self.apply_property_map()
+
+    factory = smartobject.SmartObjectFactory(Blob)
+    factory.create(opts={'id': 'b1'}).set_prop('data', b'\x00\xff')
+    with pytest.raises(TypeError):
+        factory.export(io.StringIO())
+    pytest.importorskip('msgpack')
+    stream = io.BytesIO()
+    factory.export(stream, format='msgpack')
+    stream.seek(0)
+    factory2 = smartobject.SmartObjectFactory(Blob)
+    assert factory2.import_(stream, format='msgpack') == 1
+    assert factory2.get('b1').data == b'\x00\xff'
+
+def test_factory_to_columns():
+    np = pytest.importorskip('numpy')
+    clean()
+    factory = smartobject.SmartObjectFactory(Device)
+    for i in range(5):
+        factory.create(opts={'id': f'd{i}'}).set_prop('battery', i * 10)
+    cols = factory.to_columns(path='test_data/columns')
+    assert list(cols) == ['id', 'battery', 'status']
+    assert cols['battery'].dtype == np.int64
+    assert cols['battery'].sum() == 100
+    assert cols['id'][4] == 'd4'
+    assert list(factory.to_columns(mode='info')) == ['status']
+    battery = np.load('test_data/columns/battery.npy', mmap_mode='r')
+    assert list(battery) == [0, 10, 20, 30, 40]
+    clean()
+    smartobject.define_storage(smartobject.JSONStorage())
+    factory = smartobject.SmartObjectFactory(T2, autosave=True)
+    factory.create().set_prop('login', 'test')
+    factory.create()
+    login = factory.to_columns(['login'])['login']
+    assert isinstance(login, np.ma.MaskedArray)
+    assert list(login.mask) == [False, True]
+    assert login[0] == 'test'
+
+
+def test_factory_changed_since():
+    factory = smartobject.SmartObjectFactory(Device, versioning=True)
+    for i in range(3):
+        factory.create(opts={'id': f'd{i}'})
+    v = factory.version
+    assert v == 3
+    assert factory.changed_since(2) == [('d2', {'id', 'battery', 'status'}, 3)]
+    factory.get('d0').set_prop('battery', 10)
+    factory.get('d1').set_prop('status', 'error')
+    factory.get('d0').set_prop('status', 'error')
+    assert factory.changed_since(v) == [('d1', {'status'}, 5),
+                                        ('d0', {'battery', 'status'}, 6)]
+    assert factory.changed_since(5) == [('d0', {'status'}, 6)]
+    assert factory.get_version('d0') == 6
+    factory.set_prop_many(['d1', 'd2'], 'battery', 50)
+    factory.delete('d1')
+    assert factory.changed_since(6) == [('d2', {'battery'}, 8),
+                                        ('d1', None, 9)]
+    assert factory.changed_since(factory.version) == []
+
+
+def test_factory_changed_since_evicted():
+    factory = smartobject.SmartObjectFactory(Device,
+                                             versioning=True,
+                                             maxsize=2)
+    factory.create(obj=Device('a'))
+    v = factory.version
+    factory.get('a').set_prop('battery', 10)
+    factory.create(obj=Device('b'))
+    factory.create(obj=Device('c'))
+    assert 'a' not in factory.get()
+    changes = factory.changed_since(v)
+    assert changes[0] == ('a', {'battery'}, v + 1)
+    assert [pk for pk, _, _ in changes] == ['a', 'b', 'c']
+    factory.remove('b')
+    assert factory.get_version('b') == v + 2
+    factory.clear()
+    assert factory.changed_since(0) == []
+
+
+def test_factory_changed_since_max_changes(backends):
+    factory = smartobject.SmartObjectFactory(Device,
+                                             versioning=True,
+                                             maxsize=10,
+                                             max_changes=20)
+    for i in range(200):
+        factory.create(obj=Device(f'd{i}'))
+    assert len(factory._changes) == 20
+    v = factory.version - 20
+    assert len(factory.changed_since(v)) == 20
+    with pytest.raises(LookupError):
+        factory.changed_since(v - 1)
+    factory.get('d199').set_prop('battery', 10)
+    assert factory.changed_since(factory.version - 1) == [
+        ('d199', {'battery'}, factory.version)
+    ]
+    assert len(factory.changed_since(v)) == 20
+    factory.create(obj=Device('d200'))
+    with pytest.raises(LookupError):
+        factory.changed_since(v)
+
+
+def test_sync_suppress_unchanged(backends):
+    s = backends[1]
+    d = Device('d1')
+    d.sync()
+    d.set_prop('battery', 50, sync=False)
+    d.sync()
+    assert s.synced == [('d1', {'battery': 100}), ('d1', {'battery': 50})]
+    suppressed = smartobject.sync.suppressed['syncs']
+    # the value flips back before the sync
+    d.set_prop('battery', 40, sync=False)
+    d.set_prop('battery', 50, sync=False)
+    d.sync()
+    assert len(s.synced) == 2
+    assert smartobject.sync.suppressed['syncs'] == suppressed + 1
+    d.sync(force=True)
+    assert s.synced[-1] == ('d1', {'battery': 50})
+
+
+def test_sync_failed(backends):
+    import asyncio
+    s = backends[1]
+    d = Device('d1')
+    d.set_prop('battery', 50, sync=False)
+    s.fail = True
+    with pytest.raises(ConnectionError):
+        d.sync()
+    s.fail = False
+    # the failed payload is not suppressed and the prop is still modified
+    d.sync()
+    assert s.synced == [('d1', {'battery': 50})]
+    d.set_prop('battery', 40, sync=False)
+    s.fail = True
+    with pytest.raises(ConnectionError):
+        asyncio.run(d.async_sync())
+    s.fail = False
+    d.set_prop('battery', 50, sync=False)
+    d.sync()
+    # 50 has been delivered already
+    assert s.synced == [('d1', {'battery': 50})]
+    d.set_prop('battery', 40, sync=False)
+    d.sync()
+    assert s.synced[-1] == ('d1', {'battery': 40})
+    factory = smartobject.SmartObjectFactory(Device)
+    factory.create(obj=d)
+    s.fail = True
+    with pytest.raises(ConnectionError):
+        factory.set_prop_many(['d1'], 'battery', 30)
+    s.fail = False
+    factory.sync_many()
+    assert s.batches[-1] == [('d1', {'battery': 30})]
+
+
+def test_async(backends):
+    import asyncio
+    s = backends[1]
+    storage = AsyncRecorderStorage({'d1': {'battery': 20, 'status': 'ok'}})
+    smartobject.define_storage(storage)
+
+    async def main():
+        factory = smartobject.SmartObjectFactory(Device, autoload=True)
+        objects = await asyncio.gather(
+            *(factory.async_get('d1') for _ in range(5)))
+        assert storage.loads == 1
+        assert all(o is objects[0] for o in objects)
+        d = objects[0]
+        assert d.battery == 20
+        # blocking syncs are called in executor
+        assert s.synced == [('d1', {'battery': 20})]
+        with pytest.raises(LookupError):
+            await factory.async_get('d2')
+        d.set_prop('battery', 30, sync=False)
+        await d.async_save()
+        assert storage.data['d1']['battery'] == 30
+        await d.async_sync()
+        assert s.synced[-1] == ('d1', {'battery': 30})
+        for i in range(3):
+            factory.create(obj=Device(f'x{i}'))
+        await factory.async_save_many(limit=2)
+        assert storage.data['x2'] == {'battery': 100, 'status': 'ok'}
+        factory.clear()
+        objects = await factory.async_get_many(['x0', 'x1', 'x0'])
+        assert list(objects) == ['x0', 'x1']
+
+    asyncio.run(main())
+
+
+def test_async_backend_blocking_call(backends):
+    storage = AsyncRecorderStorage()
+    smartobject.define_storage(storage)
+    factory = smartobject.SmartObjectFactory(Device, maxsize=1)
+    d = factory.create(obj=Device('d1'))
+    d.set_prop('battery', 50, sync=False)
+    with pytest.raises(RuntimeError):
+        d.save()
+    with pytest.raises(RuntimeError):
+        factory.save_many()
+    # the dirty object can not be saved, so it is not evicted
+    factory.create(obj=Device('d2'))
+    assert factory.dirty_evictions == 0
+    assert factory.get('d1') is d
+    assert d._is_modified()
+    assert storage.data == {}
+
+
+def test_async_eviction(backends):
+    import asyncio
+    storage = AsyncRecorderStorage(
+        {f'd{i}': {'battery': 20, 'status': 'ok'} for i in range(10)})
+    smartobject.define_storage(storage)
+
+    async def main():
+        factory = smartobject.SmartObjectFactory(Device,
+                                                 autoload=True,
+                                                 maxsize=2)
+        for i in range(10):
+            d = await factory.async_get(f'd{i}')
+            d.set_prop('battery', i, sync=False)
+        # dirty objects are evicted with async saves
+        assert factory.dirty_evictions == 8
+        assert len(factory._objects) == 2
+        for i in range(8):
+            assert storage.data[f'd{i}']['battery'] == i
+        factory = smartobject.SmartObjectFactory(Device,
+                                                 autoload=True,
+                                                 ttl=0.01)
+        d = await factory.async_get('d0')
+        d.set_prop('battery', 50, sync=False)
+        await asyncio.sleep(0.02)
+        assert await factory.async_get('d0') is not d
+        assert factory.dirty_evictions == 1
+        assert storage.data['d0']['battery'] == 50
+
+    asyncio.run(main())
+
+def test_async_backend_metrics(backends):
+    import asyncio
+    storage = AsyncRecorderStorage({'d1': {'battery': 20, 'status': 'ok'}})
+    smartobject.define_storage(storage)
+    metrics = smartobject.metrics.instrument()
+
+    async def main():
+        factory = smartobject.SmartObjectFactory(Device, autoload=True)
+        d = await factory.async_get('d1')
+        with pytest.raises(LookupError):
+            await factory.async_get('d2')
+        d.set_prop('battery', 30, sync=False)
+        await d.async_save()
+
+    try:
+        asyncio.run(main())
+        stats = metrics.stats()['storage'][None]
+        assert stats['load']['calls'] == 2
+        assert stats['load']['errors'] == 1
+        assert stats['load']['payload_bytes'] > 0
+        assert stats['load']['time']['sum'] >= 0.02
+        assert stats['save']['calls'] == 1
+        assert storage.data['d1']['battery'] == 30
+    finally:
+        smartobject.metrics.uninstrument()
+
+class FileSync(smartobject.AbstractSync):
+
+    def __init__(self, fname):
+        self.fname = fname
+
+    def sync(self, pk, data, **kwargs):
+        with open(self.fname, 'a') as fh:
+            fh.write(f'{pk} {data["battery"]}\n')
+
+
+class DuckFileSync:
+    # synchronizer, which doesn't inherit AbstractSync and has no sync_many
+
+    def __init__(self, fname):
+        self.fname = fname
+
+    def sync(self, pk, data, **kwargs):
+        with open(self.fname, 'a') as fh:
+            fh.write(f'{pk} {data["battery"]}\n')
+
+    def delete(self, pk, **kwargs):
+        pass
+
+
+@pytest.mark.parametrize('sync_class', [FileSync, DuckFileSync])
+def test_process_sync(sync_class):
+    fname = 'test_data/process_sync.txt'
+    Path(fname).unlink(missing_ok=True)
+    s = smartobject.ProcessSync(sync_class(fname),
+                                workers=3,
+                                queue_size=5,
+                                start_method='fork')
+    smartobject.define_sync(s)
+    try:
+        factory = smartobject.SmartObjectFactory(Device)
+        devices = [factory.create(obj=Device(f'd{i}')) for i in range(4)]
+        for v in range(30):
+            for d in devices:
+                d.set_prop('battery', v, sync=False)
+                d.sync()
+        factory.set_prop_many([d.id for d in devices], 'battery', 100)
+        s.flush()
+        with open(fname) as fh:
+            lines = [line.split() for line in fh]
+        for d in devices:
+            values = [int(v) for pk, v in lines if pk == d.id]
+            assert values == list(range(30)) + [100]
+    finally:
+        s.stop()
+        smartobject.define_sync(smartobject.DummySync())
+    with pytest.raises(RuntimeError):
+        s.sync('d1', {'battery': 1})
+
+
+def test_shared_factory():
+    import multiprocessing
+    factory = smartobject.SmartObjectFactory(Device, versioning=True)
+    for i in range(10):
+        factory.create(obj=Device(f'd{i}'))
+    with smartobject.SharedFactory(factory, size=1024 * 1024) as shared:
+        assert shared.publish() == 1
+        # not changed
+        assert shared.publish() == 1
+        factory.set_prop('d1', 'battery', 50)
+        assert shared.publish() == 2
+
+        def worker(q):
+            with smartobject.SharedFactoryReader(shared.name) as reader:
+                q.put((reader.version, len(reader), reader.get('d1'),
+                       'd10' in reader))
+
+        q = multiprocessing.get_context('fork').Queue()
+        p = multiprocessing.get_context('fork').Process(target=worker,
+                                                        args=(q,))
+        p.start()
+        assert q.get(timeout=10) == (2, 10, {
+            'id': 'd1',
+            'battery': 50,
+            'status': 'ok'
+        }, False)
+        p.join()
+        with smartobject.SharedFactoryReader(shared.name) as reader:
+            with pytest.raises(KeyError):
+                reader.get('d10')
+            factory.create(obj=Device('d10'))
+            shared.publish()
+            assert reader.version == 3
+            assert reader.get('d10')['battery'] == 100
+            assert list(reader.get_many(['d1', 'd10', 'x'])) == ['d1', 'd10']
+        small = smartobject.SharedFactory(factory, size=100)
+        try:
+            with pytest.raises(RuntimeError):
+                small.publish()
+        finally:
+            small.close()
+
+
 def test_t2_save_to_file():
     clean()
     smartobject.define_storage(smartobject.JSONStorage())
@@ -521,6 +1257,89 @@ def test_factory_indexes():
     assert len(factory.get('test', prop='login')) == 0
 
 
+def test_factory_index_auto_update():
+    clean()
+    smartobject.define_storage(smartobject.JSONStorage())
+    factory = smartobject.SmartObjectFactory(T2, autosave=True)
+    o1 = factory.create()
+    o2 = factory.create()
+    o1.set_prop('login', 'test')
+    factory.add_index('login')
+    assert factory.get('test', prop='login') == [o1]
+    o2.set_prop('login', 'test')
+    assert len(factory.get('test', prop='login')) == 2
+    factory.set_prop(o1.id, 'login', 'test2')
+    assert factory.get('test', prop='login') == [o2]
+    assert factory.get('test2', prop='login') == [o1]
+    o2.set_prop('login', None)
+    assert factory.get('test', prop='login') == []
+    with pytest.raises(ValueError):
+        factory.add_index('login')
+
+
+def test_factory_find():
+    clean()
+    smartobject.define_storage(smartobject.JSONStorage())
+    factory = smartobject.SmartObjectFactory(T2, autosave=True)
+    factory.add_index('login', sorted=True)
+    objects = {}
+    for login in ('a1', 'a2', 'b1', 'b2', 'c1'):
+        o = factory.create()
+        o.set_prop('login', login)
+        objects[login] = o
+
+    def logins(result):
+        return [o.login for o in result]
+
+    assert logins(factory.find('login', ge='a2', lt='c1')) == ['a2', 'b1', 'b2']
+    assert logins(factory.find('login', gt='a2', le='c1')) == ['b1', 'b2', 'c1']
+    assert logins(factory.find('login', prefix='b')) == ['b1', 'b2']
+    assert logins(factory.find('login', limit=2, reverse=True)) == ['c1', 'b2']
+    objects['a1'].set_prop('login', 'd1')
+    assert logins(factory.find('login', lt='b')) == ['a2']
+    assert factory.get('d1', prop='login') == [objects['a1']]
+    factory.remove(objects['c1'])
+    assert logins(factory.find('login', gt='b')) == ['b1', 'b2', 'd1']
+    with pytest.raises(ValueError):
+        factory.find('password')
+
+
+def test_factory_query():
+    clean()
+    smartobject.define_storage(smartobject.JSONStorage())
+    factory = smartobject.SmartObjectFactory(T2, autosave=True)
+    factory.add_index('login', sorted=True)
+    factory.add_index(['login', 'password'], composite=True)
+    for login, password in (('a', '1'), ('a', '2'), ('b', '1'), ('c', '1'),
+                            ('c', None)):
+        factory.create().set_prop({'login': login, 'password': password})
+
+    def q(where):
+        return sorted((o.login, o.password or '') for o in factory.query(where))
+
+    assert q({'login': 'a', 'password': '2'}) == [('a', '2')]
+    assert q({'login': {'in': ['a', 'c']}, 'password': {'ne': '1'}}) == [
+        ('a', '2'), ('c', '')
+    ]
+    assert q({'login': {'gt': 'a', 'le': 'c'}, 'password': '1'}) == [
+        ('b', '1'), ('c', '1')
+    ]
+    assert q({'password': None}) == [('c', '')]
+    assert q({'login': {'nin': ['a']}, 'password': {'eq': '1'}}) == [
+        ('b', '1'), ('c', '1')
+    ]
+    assert len(factory.query({'login': {'ge': 'a'}}, limit=2)) == 2
+    plan = factory.explain({'login': 'a', 'password': '2'})
+    assert plan['indexes'][0]['index'] == ('login', 'password')
+    assert plan['candidates'] == 1
+    assert factory.explain({'password': '1'})['scan'] is True
+    factory.get(('a', '2'), prop=('login', 'password'))[0].set_prop(
+        'password', '3')
+    assert q({'login': 'a', 'password': '3'}) == [('a', '3')]
+    with pytest.raises(ValueError):
+        factory.query({'login': {'like': 'a'}})
+
+
 def test_factory_autoload():
     clean()
     storage = smartobject.JSONStorage()
@@ -546,6 +1365,144 @@ def test_factory_autoload():
         assert factory.get(pk3)
 
 
+def test_factory_autoload_single_flight():
+    import threading
+    import time
+
+    class SlowStorage(smartobject.AbstractStorage):
+
+        def __init__(self):
+            self.loads = 0
+
+        def load(self, pk, **kwargs):
+            self.loads += 1
+            time.sleep(0.1)
+            if pk == 'missing':
+                raise LookupError
+            return {'login': 'test'}
+
+    storage = SlowStorage()
+    smartobject.define_storage(storage)
+    factory = smartobject.SmartObjectFactory(T2, autoload=True)
+    result = []
+    errors = []
+
+    def get(pk):
+        try:
+            result.append(factory.get(pk))
+        except LookupError as e:
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=get, args=(pk,))
+        for pk in ['o1'] * 5 + ['missing'] * 5
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert storage.loads == 2
+    assert len(result) == 5
+    assert all(o is result[0] for o in result)
+    assert result[0].login == 'test'
+    assert len(errors) == 5
+
+
+def test_factory_negative_cache():
+    clean()
+    storage = smartobject.JSONStorage()
+    storage.allow_empty = False
+    smartobject.define_storage(storage)
+    factory = smartobject.SmartObjectFactory(T2,
+                                             autoload=True,
+                                             negative_ttl=60,
+                                             negative_maxsize=2)
+    for i in range(3):
+        with pytest.raises(FileNotFoundError):
+            factory.get('o1')
+    assert factory.negative_hits == 2
+    factory.create(opts={'id': 'o1'}, save=True)
+    factory.clear()
+    assert factory.get('o1').id == 'o1'
+    for pk in ('o2', 'o3', 'o4'):
+        with pytest.raises(FileNotFoundError):
+            factory.get(pk)
+    assert list(factory._negative) == ['o3', 'o4']
+
+
+def test_factory_get_many():
+    clean()
+    storage = smartobject.JSONStorage()
+    storage.allow_empty = False
+    smartobject.define_storage(storage)
+    factory = smartobject.SmartObjectFactory(T2, autoload=True, autosave=True)
+    for pk in ('o1', 'o2', 'o3'):
+        factory.create(opts={'id': pk}).set_prop('login', f'test_{pk}',
+                                                 save=True)
+    factory.clear()
+    o1 = factory.get('o1')
+    result = factory.get_many(['o1', 'o2', 'o3', 'o4'])
+    assert sorted(result) == ['o1', 'o2', 'o3']
+    assert result['o1'] is o1
+    assert result['o3'].login == 'test_o3'
+    assert factory.get('o2') is result['o2']
+    with pytest.raises(KeyError):
+        factory.get_many(['o1', 'o4'], missing='raise')
+    assert factory.get_many(['o4'], missing='create')['o4'].login is None
+
+
+def test_factory_get_many_duck_storage():
+    import threading
+    import time
+
+    class DuckStorage:
+        # storage, which doesn't inherit AbstractStorage and has no load_many
+
+        def load(self, pk, **kwargs):
+            time.sleep(0.1)
+            if pk == 'a':
+                return {'battery': 5}
+            raise FileNotFoundError(pk)
+
+    smartobject.define_storage(DuckStorage())
+    try:
+        factory = smartobject.SmartObjectFactory(Device, autoload=True)
+        result = factory.get_many(['a', 'b'])
+        assert list(result) == ['a']
+        assert result['a'].battery == 5
+
+        def get():
+            with pytest.raises(FileNotFoundError):
+                factory.get('c')
+
+        # the object is being loaded by another thread
+        t = threading.Thread(target=get)
+        t.start()
+        time.sleep(0.03)
+        assert factory.get_many(['c']) == {}
+        t.join()
+    finally:
+        smartobject.define_storage(smartobject.DummyStorage())
+
+
+def test_factory_get_many_db():
+    clean()
+    db = _prepare_t2_db()
+    storage = smartobject.SQLAStorage(db, 't2')
+    smartobject.define_storage(storage)
+    factory = smartobject.SmartObjectFactory(T2, autoload=True, autosave=True)
+    ids = []
+    for i in range(3):
+        obj = factory.create()
+        obj.set_prop('login', f'test{obj.id}', save=True)
+        ids.append(obj.id)
+    factory.clear()
+    result = factory.get_many(ids + [999])
+    assert sorted(result) == ids
+    for i in ids:
+        assert result[i].login == f'test{i}'
+
+
 def test_factory_lru():
     clean()
     smartobject.define_storage(smartobject.JSONStorage())
@@ -566,6 +1523,169 @@ def test_factory_lru():
     with pytest.raises(RuntimeError):
         factory.cleanup_storage()
 
+
+def test_factory_lru_order():
+    clean()
+    smartobject.define_storage(smartobject.JSONStorage())
+    factory = smartobject.SmartObjectFactory(T2, autosave=True, maxsize=2)
+    o1 = factory.create()
+    o2 = factory.create()
+    factory.get(o1.id)
+    o3 = factory.create()
+    assert list(factory._objects) == [o1.id, o3.id]
+    factory.serialize(o1.id)
+    factory.create()
+    assert o1.id in factory._objects
+    assert o3.id not in factory._objects
+
+
+def test_factory_writeback():
+    clean()
+    storage = smartobject.JSONStorage()
+    storage.allow_empty = False
+    smartobject.define_storage(storage)
+    factory = smartobject.SmartObjectFactory(T2, autoload=True, maxsize=1)
+    o1 = factory.create(opts={'id': 'o1'}, save=True)
+    o1.set_prop('login', 'test')
+    factory.create(opts={'id': 'o2'}, save=True)
+    assert factory.dirty_evictions == 1
+    assert factory.flush_time > 0
+    factory.create(opts={'id': 'o3'}, save=True)
+    assert factory.dirty_evictions == 1
+    assert factory.get('o1').login == 'test'
+
+
+def test_factory_max_bytes():
+    clean()
+    smartobject.define_storage(smartobject.JSONStorage())
+    factory = smartobject.SmartObjectFactory(
+        T2,
+        autosave=True,
+        max_bytes=10000,
+        sizer=lambda obj: len(obj.password or '') + 100)
+    o1 = factory.create()
+    o2 = factory.create()
+    assert factory.total_bytes == 200
+    o1.set_prop('password', 'x' * 5000, save=True)
+    assert factory.total_bytes == 5200
+    assert factory.largest_objects(1) == [(o1.id, 5100)]
+    o2.set_prop('password', 'x' * 5000, save=True)
+    factory.get(o1.id)
+    o3 = factory.create()
+    # least recently used object is evicted
+    assert o2.id not in factory._objects
+    assert o1.id in factory._objects
+    assert factory.total_bytes == 5200
+    factory.remove(o3)
+    assert factory.total_bytes == 5100
+
+
+def test_factory_ttl():
+    import time
+    clean()
+    smartobject.define_storage(smartobject.JSONStorage())
+    evicted = []
+    factory = smartobject.SmartObjectFactory(
+        T2,
+        autosave=True,
+        ttl=0.2,
+        idle_ttl=0.1,
+        on_evict=lambda obj, reason: evicted.append((obj.id, reason)))
+    o1 = factory.create()
+    o2 = factory.create()
+    time.sleep(0.06)
+    factory.get(o1.id)
+    time.sleep(0.06)
+    with pytest.raises(KeyError):
+        factory.get(o2.id)
+    assert evicted == [(o2.id, 'idle')]
+    factory.get(o1.id)
+    factory.start_reaper(interval=0.02)
+    try:
+        time.sleep(0.2)
+    finally:
+        factory.stop_reaper()
+    assert not factory.get()
+    assert evicted[1] in ((o1.id, 'ttl'), (o1.id, 'idle'))
+
+
+def test_factory_load_by_secondary_evict(backends):
+    # loading objects by secondary key evicts dirty objects, while other
+    # threads modify them
+    import threading
+    storage = backends[0]
+    storage.data['v'] = {'battery': 1, 'status': 'error'}
+    factory = smartobject.SmartObjectFactory(Device,
+                                             maxsize=1,
+                                             versioning=True,
+                                             autoload=True)
+    factory.add_index('status')
+
+    def modify(obj, done):
+        i = 0
+        while not done.is_set():
+            i += 1
+            obj.set_prop('battery', i % 100)
+
+    def load(done):
+        for _ in range(20):
+            factory.get('error', prop='status', get_all=True)
+        done.set()
+
+    for _ in range(10):
+        x = factory.create(obj=Device('x'), override=True)
+        done = threading.Event()
+        workers = [
+            threading.Thread(target=modify, args=(x, done), daemon=True),
+            threading.Thread(target=load, args=(done,), daemon=True)
+        ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join(10)
+            assert not w.is_alive(), 'deadlock'
+
+
+def test_factory_remove_autoload_unlocked(backends):
+    # objects are auto-loaded by remove() and reindex() without holding the
+    # factory lock
+    storage = backends[0]
+    storage.data.update({'d1': {'battery': 1}, 'd2': {'battery': 2}})
+    factory = smartobject.SmartObjectFactory(Device, autoload=True)
+    locked = []
+    load = storage.load
+
+    def locked_load(pk, **kwargs):
+        locked.append(factory._SmartObjectFactory__lock._is_owned())
+        return load(pk, **kwargs)
+
+    storage.load = locked_load
+    factory.reindex('d1')
+    factory.remove('d2')
+    assert locked == [False, False]
+    assert list(factory.get()) == ['d1']
+
+def test_set_prop_hook_error(backends):
+    s = backends[1]
+
+    def sizer(obj):
+        if obj.battery == 50:
+            raise ValueError
+        return 100
+
+    factory = smartobject.SmartObjectFactory(Device, sizer=sizer)
+    d = factory.create(obj=Device('d1'))
+    d.save()
+    d.sync()
+    assert not d._is_modified()
+    with pytest.raises(ValueError):
+        d.set_prop('battery', 50, sync=False)
+    # the value is set and marked as modified
+    assert d.battery == 50
+    assert d._is_modified()
+    d.sync()
+    assert s.synced[-1] == ('d1', {'battery': 50})
+
 def test_factory_load_by_secondary():
     db = _prepare_t2_db()
     storage = smartobject.SQLAStorage(db, 't2')